@@ -0,0 +1,477 @@
+import numpy as np
+cimport numpy as np
+cimport cython
+from cython.parallel cimport prange
+cimport openmp
+from libc.math cimport sqrt, sin, cos, INFINITY
+
+# Number of pairs below which the overlap test runs on one thread, as
+# starting a thread team would take longer than the test itself.
+cdef Py_ssize_t min_parallel_pairs = 4096
+
+
+def set_num_threads(int n):
+    """Set the number of threads the compiled kernels use, such as 1 in a
+    worker process that shares the CPUs with others."""
+    openmp.omp_set_num_threads(n)
+
+
+cdef inline double _clip(double x, double x_max) noexcept nogil:
+    if x > x_max:
+        return x_max
+    elif x < -x_max:
+        return -x_max
+    return x
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double _end_radial_distance_sq(double[:, :] r, double[:, :] u,
+                                           Py_ssize_t i, Py_ssize_t dim,
+                                           double l_half) noexcept nogil:
+    cdef:
+        Py_ssize_t d
+        double r_rad_1_sq = 0.0, r_rad_2_sq = 0.0
+
+    for d in range(dim):
+        r_rad_1_sq += (r[i, d] + u[i, d] * l_half) ** 2
+        r_rad_2_sq += (r[i, d] - u[i, d] * l_half) ** 2
+    return max(r_rad_1_sq, r_rad_2_sq)
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def spherocylinder_radial_distance_sq(double[:, :] r, double[:, :] u,
+                                      double l, double R, double R_d):
+    cdef:
+        Py_ssize_t i, dim = r.shape[1]
+        double l_half = l / 2.0
+        np.ndarray[np.float_t, ndim=1] r_rad_sq = np.empty(r.shape[0])
+        double[:] r_rad_sq_v = r_rad_sq
+
+    with nogil:
+        for i in range(r.shape[0]):
+            r_rad_sq_v[i] = _end_radial_distance_sq(r, u, i, dim, l_half)
+    return r_rad_sq
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint _spherocylinders_overlap(const double[:, :] r,
+                                          const double[:, :] u,
+                                          Py_ssize_t a, Py_ssize_t b,
+                                          Py_ssize_t dim, double l_half,
+                                          double d_sq_max) noexcept nogil:
+    cdef:
+        Py_ssize_t d
+        double u_a_u_b = 0.0, u_a_w = 0.0, u_b_w = 0.0
+        double denom, s, t, w_d, sep_sq = 0.0
+
+    for d in range(dim):
+        w_d = r[a, d] - r[b, d]
+        u_a_u_b += u[a, d] * u[b, d]
+        u_a_w += u[a, d] * w_d
+        u_b_w += u[b, d] * w_d
+
+    # Closest points between the two segments.
+    denom = 1.0 - u_a_u_b * u_a_u_b
+    if denom < 1e-10:
+        s = 0.0
+    else:
+        s = _clip((u_a_u_b * u_b_w - u_a_w) / denom, l_half)
+    t = _clip(s * u_a_u_b + u_b_w, l_half)
+    s = _clip(t * u_a_u_b - u_a_w, l_half)
+
+    for d in range(dim):
+        w_d = r[a, d] - r[b, d] + s * u[a, d] - t * u[b, d]
+        sep_sq += w_d * w_d
+    return sep_sq < d_sq_max
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def spherocylinder_intersection(const double[:, :] r, const double[:, :] u,
+                                double l, double R,
+                                const Py_ssize_t[:] i, const Py_ssize_t[:] j):
+    cdef:
+        Py_ssize_t k, n_pairs = i.shape[0], dim = r.shape[1]
+        double l_half = l / 2.0, d_sq_max = (2.0 * R) ** 2
+        np.ndarray[np.uint8_t, ndim=1] overlap = np.zeros(n_pairs,
+                                                          dtype=np.uint8)
+        unsigned char[:] overlap_v = overlap
+        np.ndarray[np.uint8_t, ndim=1] c = np.zeros(r.shape[0],
+                                                    dtype=np.uint8)
+        unsigned char[:] c_v = c
+
+    with nogil:
+        if n_pairs >= min_parallel_pairs:
+            for k in prange(n_pairs, schedule='static'):
+                overlap_v[k] = _spherocylinders_overlap(r, u, i[k], j[k], dim,
+                                                        l_half, d_sq_max)
+        else:
+            for k in range(n_pairs):
+                overlap_v[k] = _spherocylinders_overlap(r, u, i[k], j[k], dim,
+                                                        l_half, d_sq_max)
+
+        for k in range(n_pairs):
+            if overlap_v[k]:
+                c_v[i[k]] = 1
+                c_v[j[k]] = 1
+    return c.view(np.bool)
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef unsigned int _droplet_wall(double[:, :] r, double[:, :] u, double l,
+                                double R, double R_d,
+                                bint align) noexcept nogil:
+    cdef:
+        Py_ssize_t i, d, dim = r.shape[1]
+        unsigned int n_wall = 0
+        double l_half = l / 2.0, R_max = R_d - R
+        double r_rad_sq, r_mag, u_dot_u_r, u_mag
+        double r_new_mag, r_touch = sqrt(R_max ** 2 - l_half ** 2)
+        # Centres at most this far out cannot put an end past the wall.
+        double r_bulk_sq = (R_max - l_half) ** 2 if R_max > l_half else -1.0
+
+    for i in range(r.shape[0]):
+        r_mag = 0.0
+        for d in range(dim):
+            r_mag += r[i, d] ** 2
+        if r_mag <= r_bulk_sq:
+            continue
+        r_rad_sq = _end_radial_distance_sq(r, u, i, dim, l_half)
+        if r_rad_sq <= R_max ** 2:
+            continue
+        n_wall += 1
+        r_mag = sqrt(r_mag)
+
+        if align:
+            # Project the orientation onto the wall's tangent plane,
+            # and make the spherocylinder touch the wall.
+            u_dot_u_r = 0.0
+            if r_mag > 0.0:
+                for d in range(dim):
+                    u_dot_u_r += u[i, d] * r[i, d] / r_mag
+            u_mag = 0.0
+            for d in range(dim):
+                if r_mag > 0.0:
+                    u[i, d] -= r[i, d] / r_mag * u_dot_u_r
+                u_mag += u[i, d] ** 2
+            u_mag = sqrt(u_mag)
+            for d in range(dim):
+                if u_mag > 0.0:
+                    u[i, d] /= u_mag
+                if r_mag > 0.0:
+                    r[i, d] *= r_touch / r_mag
+                else:
+                    r[i, d] = 0.0
+            r_rad_sq = _end_radial_distance_sq(r, u, i, dim, l_half)
+            if r_rad_sq <= R_max ** 2:
+                continue
+            r_mag = r_touch
+
+        # Push the spherocylinder back inside the wall.
+        r_new_mag = r_mag - (sqrt(r_rad_sq) - R_max)
+        for d in range(dim):
+            if r_mag > 0.0:
+                r[i, d] *= r_new_mag / r_mag
+            else:
+                r[i, d] = 0.0
+    return n_wall
+
+
+def droplet_wall(double[:, :] r, double[:, :] u, double l, double R,
+                 double R_d, bint align):
+    return _droplet_wall(r, u, l, R, R_d, align)
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _rotate(double[:, :] u, Py_ssize_t i, const double[:] th,
+                  double th_scale) noexcept nogil:
+    # Rotate u[i] by the angles th * th_scale: about the axis th in 3D,
+    # as in `spatious.rotation.rotate`, or in the plane in 2D.
+    cdef:
+        Py_ssize_t d
+        double ang, c, s, k[3], u_r[3], k_dot_u, u_0
+
+    if u.shape[1] == 2:
+        ang = th[0] * th_scale
+        c = cos(ang)
+        s = sin(ang)
+        u_0 = u[i, 0]
+        u[i, 0] = c * u_0 - s * u[i, 1]
+        u[i, 1] = s * u_0 + c * u[i, 1]
+        return
+
+    ang = sqrt(th[0] ** 2 + th[1] ** 2 + th[2] ** 2)
+    if ang == 0.0:
+        return
+    for d in range(3):
+        k[d] = th[d] / ang
+        u_r[d] = u[i, d]
+    ang *= th_scale
+    c = cos(ang)
+    s = sin(ang)
+    k_dot_u = k[0] * u_r[0] + k[1] * u_r[1] + k[2] * u_r[2]
+    u[i, 0] = (u_r[0] * c + (k[1] * u_r[2] - k[2] * u_r[1]) * s +
+               k[0] * k_dot_u * (1.0 - c))
+    u[i, 1] = (u_r[1] * c + (k[2] * u_r[0] - k[0] * u_r[2]) * s +
+               k[1] * k_dot_u * (1.0 - c))
+    u[i, 2] = (u_r[2] * c + (k[0] * u_r[1] - k[1] * u_r[0]) * s +
+               k[2] * k_dot_u * (1.0 - c))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rotate(double[:, :] u, const double[:, :] th, double th_scale=1.0):
+    # Rotate each vector in u, in place, by its angles in th * th_scale.
+    # A 2D or 3D replacement for `spatious.rotation.rotate`, which builds a
+    # rotation matrix for every vector.
+    cdef Py_ssize_t i
+    with nogil:
+        for i in range(u.shape[0]):
+            _rotate(u, i, th[i], th_scale)
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _accumulate_radial(const double[:, :] r, double R_d, double R_max,
+                             double cos_theta_max, bint hemisphere,
+                             long long[:] ns, double[:] ns_sum,
+                             double[:] ns_sq_sum,
+                             long long[:] counts) noexcept nogil:
+    # Bin the radial distances of the particles within the sector, as
+    # `utils.dataset.Dataset` selects them, and add the histogram to the
+    # running sums. Samples with no particles in the sector are only
+    # counted in `counts`, as the dataset leaves them out too.
+    cdef:
+        Py_ssize_t a, b, d, n = r.shape[0], dim = r.shape[1]
+        Py_ssize_t n_bins = ns.shape[0], count = 0
+        double r_mag, z
+
+    for b in range(n_bins):
+        ns[b] = 0
+    for a in range(n):
+        r_mag = 0.0
+        for d in range(dim):
+            r_mag += r[a, d] ** 2
+        r_mag = sqrt(r_mag)
+        z = r[a, dim - 1]
+        if r_mag > R_d or (hemisphere and z < 0.0):
+            continue
+        if (z if z > 0.0 else -z) < cos_theta_max * r_mag:
+            continue
+        count += 1
+        b = <Py_ssize_t>(n_bins * r_mag / R_max)
+        if b < n_bins:
+            ns[b] += 1
+    counts[count] += 1
+    if count:
+        for b in range(n_bins):
+            ns_sum[b] += ns[b]
+            ns_sq_sum[b] += ns[b] ** 2
+
+
+def accumulate_radial(const double[:, :] r, double R_d, double R_max,
+                      double cos_theta_max, bint hemisphere,
+                      long long[:] ns, double[:] ns_sum, double[:] ns_sq_sum,
+                      long long[:] counts):
+    with nogil:
+        _accumulate_radial(r, R_d, R_max, cos_theta_max, hemisphere, ns,
+                           ns_sum, ns_sq_sum, counts)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _hard_core(double[:, :] r, double[:, :] u, double[:, :] r_old,
+                     double[:, :] u_old, double l, double R, double R_d,
+                     bint align, unsigned char[:] reverts,
+                     unsigned char[:] c_neighb,
+                     unsigned char[:] c_prev) noexcept nogil:
+    # Like `model.do_hard_core`, but testing all pairs.
+    cdef:
+        Py_ssize_t a, b, d, n = r.shape[0], dim = r.shape[1]
+        double l_half = l / 2.0, d_sq_max = (2.0 * R) ** 2
+        bint first = True, any_c
+
+    _droplet_wall(r, u, l, R, R_d, align)
+
+    while True:
+        any_c = False
+        for a in range(n):
+            c_neighb[a] = 0
+        for a in range(n):
+            for b in range(a + 1, n):
+                if not (first or c_prev[a] or c_prev[b]):
+                    continue
+                if _spherocylinders_overlap(r, u, a, b, dim, l_half,
+                                            d_sq_max):
+                    c_neighb[a] = 1
+                    c_neighb[b] = 1
+                    any_c = True
+        if not any_c:
+            break
+        for a in range(n):
+            c_prev[a] = c_neighb[a]
+            if c_neighb[a]:
+                reverts[a] = 1
+                for d in range(dim):
+                    r[a, d] = r_old[a, d]
+                    u[a, d] = u_old[a, d]
+        first = False
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def run_steps(double[:, :] r, double[:, :] u, double v, double l, double R,
+              double D, double Dr, double R_d, double dt, double Dr_c,
+              bint align, long i, double t, double t_max, long every,
+              const double[:, :, :] noise_rot,
+              const double[:, :, :] noise_trans,
+              const double[:, :, :] noise_tumble,
+              double[:, :] r_snap, double[:, :] u_snap,
+              double[:] t_scat, double[:, :] r_scat, double t_relax,
+              bint track, bint track_always, Py_ssize_t[:] ev_i,
+              double[:] ev_t, double[:, :] ev_r1, double[:, :] ev_r2,
+              bint accumulate=False, double t_acc=0.0, double acc_R_max=0.0,
+              double acc_cos_theta=0.0, bint acc_hemisphere=False,
+              long long[:] acc_ns=None, double[:] acc_sum=None,
+              double[:] acc_sq_sum=None, long long[:] acc_counts=None,
+              long long[:] n_coll=None):
+    """Advance a droplet by up to one block of time steps, following the
+    same physics as `model.dropsim`.
+
+    Stops early once `t_max` is reached, or after any step whose state is
+    due to be output, in which case `r_snap` and `u_snap` hold that state.
+
+    If `accumulate` is set, the radial histogram of each step from `t_acc`
+    on is added to the `acc_` arrays, as `accumulate_radial` does.
+    If `n_coll` is given, the number of particles that collided in each
+    step is added to its first element.
+
+    Returns
+    -------
+    k: int
+        Number of steps taken.
+    i: int
+        Step counter.
+    t: float
+        Time.
+    n_ev: int
+        Number of scattering events written to `ev_i`, `ev_t`, `ev_r1`,
+        `ev_r2`.
+    snapped: bool
+        Whether a snapshot was taken.
+    """
+    cdef:
+        Py_ssize_t k = 0, a, d, n = r.shape[0], dim = r.shape[1]
+        Py_ssize_t n_ev = 0, n_steps = noise_trans.shape[0]
+        double rot_scale = sqrt(2.0 * Dr * dt)
+        double trans_scale = sqrt(2.0 * D * dt)
+        double tumble_scale = sqrt(2.0 * Dr_c * dt)
+        double u_mag
+        bint snapped = False, tumble_rot = Dr_c < INFINITY
+        bint count_coll = n_coll is not None
+        np.ndarray[np.float_t, ndim=2] r_old_a = np.empty_like(r)
+        np.ndarray[np.float_t, ndim=2] u_old_a = np.empty_like(u)
+        double[:, :] r_old = r_old_a, u_old = u_old_a
+        unsigned char[:] c_neighb = np.zeros(n, dtype=np.uint8)
+        unsigned char[:] c_iter = np.zeros(n, dtype=np.uint8)
+        unsigned char[:] c_prev = np.zeros(n, dtype=np.uint8)
+
+    if dim not in (2, 3):
+        raise Exception('Compiled engine only supports 2 or 3 dimensions')
+
+    with nogil:
+        while k < n_steps and t < t_max and not snapped:
+            for a in range(n):
+                c_neighb[a] = 0
+
+            if Dr:
+                r_old[...] = r
+                u_old[...] = u
+                for a in range(n):
+                    _rotate(u, a, noise_rot[k, a], rot_scale)
+                _hard_core(r, u, r_old, u_old, l, R, R_d, False, c_neighb,
+                           c_iter, c_prev)
+
+            if D:
+                r_old[...] = r
+                u_old[...] = u
+                for a in range(n):
+                    for d in range(dim):
+                        r[a, d] += trans_scale * noise_trans[k, a, d]
+                _hard_core(r, u, r_old, u_old, l, R, R_d, False, c_neighb,
+                           c_iter, c_prev)
+
+            r_old[...] = r
+            u_old[...] = u
+            for a in range(n):
+                for d in range(dim):
+                    r[a, d] += v * dt * u[a, d]
+            _hard_core(r, u, r_old, u_old, l, R, R_d, align, c_neighb,
+                       c_iter, c_prev)
+
+            i += 1
+            t += dt
+            k += 1
+
+            if every and not i % every:
+                r_snap[...] = r
+                u_snap[...] = u
+                snapped = True
+
+            if accumulate and t >= t_acc:
+                _accumulate_radial(r, R_d, acc_R_max, acc_cos_theta,
+                                   acc_hemisphere, acc_ns, acc_sum,
+                                   acc_sq_sum, acc_counts)
+
+            if Dr_c:
+                r_old[...] = r
+                u_old[...] = u
+                for a in range(n):
+                    if not c_neighb[a]:
+                        continue
+                    if tumble_rot:
+                        _rotate(u, a, noise_tumble[k - 1, a], tumble_scale)
+                    else:
+                        # Pick a new direction uniformly on the sphere.
+                        u_mag = 0.0
+                        for d in range(dim):
+                            u_mag += noise_tumble[k - 1, a, d] ** 2
+                        u_mag = sqrt(u_mag)
+                        for d in range(dim):
+                            u[a, d] = noise_tumble[k - 1, a, d] / u_mag
+                _hard_core(r, u, r_old, u_old, l, R, R_d, False, c_neighb,
+                           c_iter, c_prev)
+
+            if count_coll:
+                for a in range(n):
+                    n_coll[0] += c_neighb[a]
+
+            if track:
+                for a in range(n):
+                    if t > t_scat[a]:
+                        ev_i[n_ev] = a
+                        ev_t[n_ev] = t
+                        for d in range(dim):
+                            ev_r1[n_ev, d] = r_scat[a, d]
+                            ev_r2[n_ev, d] = r[a, d]
+                        n_ev += 1
+                        t_scat[a] = INFINITY
+                for a in range(n):
+                    if ((c_neighb[a] or track_always) and
+                            t_scat[a] == INFINITY):
+                        t_scat[a] = t + t_relax
+                        for d in range(dim):
+                            r_scat[a, d] = r[a, d]
+    return k, i, t, n_ev, snapped
@@ -0,0 +1,244 @@
+"""
+Functions relating to gathering statistics while a simulation runs.
+"""
+from __future__ import print_function, division
+import numpy as np
+from mindrop import numerics
+
+
+class RadialAccumulator(object):
+    """Running histogram of particles' radial distances, taken every step,
+    of the particles that `utils.dataset.Dataset` would select.
+
+    As in the dataset, a particle is selected if it is inside the droplet
+    and within a half-angle `theta_max` of the last axis, in either
+    direction, and, if `hemisphere` is set, on its positive side. Samples
+    with no particles selected are left out of the averages.
+
+    Parameters
+    ----------
+    n: int
+        Number of particles.
+    R_d: float
+        Droplet radius.
+    dr: float
+        Bin width.
+    theta_max: float
+        Sector half-angle.
+    hemisphere: bool
+        Whether to only select particles on the positive side of the last
+        axis.
+    buff: float
+        Histogram range, as a multiple of the droplet radius.
+    t_start: float
+        Time from which to start taking samples, such as once the system is
+        in steady state.
+    """
+
+    def __init__(self, n, R_d, dr, theta_max=np.pi / 3.0, hemisphere=True,
+                 buff=1.1, t_start=0.0):
+        if theta_max > np.pi / 2.0:
+            raise Exception('theta_max must be less than or equal to pi / 2')
+        self.R_d = R_d
+        self.theta_max = theta_max
+        self.hemisphere = hemisphere
+        self.t_start = t_start
+        self.R_max = buff * R_d
+        n_bins = int(round(self.R_max / dr))
+        self.R_edges = np.linspace(0.0, self.R_max, n_bins + 1)
+        self.ns_sum = np.zeros([n_bins])
+        self.ns_sq_sum = np.zeros([n_bins])
+        self.counts = np.zeros([n + 1], dtype=np.int64)
+        self._ns = np.empty([n_bins], dtype=np.int64)
+
+    def update(self, t, r):
+        """Add a sample, if it is from late enough.
+
+        Parameters
+        ----------
+        t: float
+            Current time.
+        r: array, shape (n, d)
+            Current particle positions.
+        """
+        if t >= self.t_start:
+            numerics.accumulate_radial(r, self.R_d, self.R_max,
+                                       np.cos(self.theta_max),
+                                       self.hemisphere, self._ns, self.ns_sum,
+                                       self.ns_sq_sum, self.counts)
+
+    def kernel_args(self):
+        """Arguments with which `numerics.run_steps` updates the
+        accumulator."""
+        return dict(accumulate=True, t_acc=self.t_start, acc_R_max=self.R_max,
+                    acc_cos_theta=np.cos(self.theta_max),
+                    acc_hemisphere=self.hemisphere, acc_ns=self._ns,
+                    acc_sum=self.ns_sum, acc_sq_sum=self.ns_sq_sum,
+                    acc_counts=self.counts)
+
+    def get_ns(self):
+        """Mean and standard error of the number of particles in each
+        bin, and the bin edges, as from `Dataset.get_ns`."""
+        m = self.counts[1:].sum()
+        ns = self.ns_sum / m
+        ns_var = (self.ns_sq_sum / m - ns ** 2) * m / (m - 1.0)
+        return ns, np.sqrt(ns_var / m), self.R_edges
+
+    def get_n(self):
+        """Mean and standard error of the number of particles selected, as
+        from `Dataset.get_n`."""
+        counts = self.counts[1:]
+        ns = np.arange(1, len(self.counts))
+        m = counts.sum()
+        n = np.sum(counts * ns) / m
+        n_var = np.sum(counts * (ns - n) ** 2) / (m - 1.0)
+        return n, np.sqrt(n_var / m)
+
+    def save(self, fname):
+        np.savez(fname, R_d=self.R_d, theta_max=self.theta_max,
+                 hemisphere=self.hemisphere, t_start=self.t_start,
+                 R_edges=self.R_edges, ns_sum=self.ns_sum,
+                 ns_sq_sum=self.ns_sq_sum, counts=self.counts)
+
+
+def load(fname):
+    """Load an accumulator written by `RadialAccumulator.save`."""
+    with np.load(fname) as f:
+        acc = RadialAccumulator(len(f['counts']) - 1, float(f['R_d']),
+                                1.0, float(f['theta_max']),
+                                bool(f['hemisphere']),
+                                t_start=float(f['t_start']))
+        acc.R_edges = f['R_edges']
+        acc.R_max = acc.R_edges[-1]
+        acc.ns_sum = f['ns_sum']
+        acc.ns_sq_sum = f['ns_sq_sum']
+        acc.counts = f['counts']
+        acc._ns = np.empty([len(acc.ns_sum)], dtype=np.int64)
+    return acc
+
+
+class SteadyStateMonitor(object):
+    """Decide when a run has reached a steady state, from block averages of
+    some observables.
+
+    The observables are the mean radial distance of the particles, as a
+    fraction of the droplet radius, the fraction of particles in the peak
+    near the wall, and the collision rate, as the fraction of particles
+    that collide per step. Samples are averaged over blocks of time
+    `t_block`. Each time a block is completed, the run is judged steady if,
+    for every observable, the means of the two halves of the last
+    `n_blocks` blocks differ by no more than a fraction `tol` of their
+    overall mean, plus `n_sigma` standard errors of that difference.
+
+    Parameters
+    ----------
+    R_d: float
+        Droplet radius.
+    t_block: float
+        Length of time over which to average each block.
+    n_blocks: int
+        Number of blocks to compare. Must be even, and at least 4.
+    tol: float
+        Relative tolerance.
+    n_sigma: float
+        Number of standard errors of the difference to allow on top of the
+        relative tolerance. The standard error of a few noisy blocks can
+        be much larger than the tolerance, so this is off by default.
+    r_peak: float
+        Radial distance, as a fraction of the droplet radius, beyond which a
+        particle is in the peak.
+    t_min: float
+        Time before which the run never counts as steady.
+    """
+
+    names = ('r_mean', 'f_peak', 'coll_rate')
+
+    def __init__(self, R_d, t_block, n_blocks=10, tol=0.02, n_sigma=0.0,
+                 r_peak=0.8, t_min=0.0):
+        if n_blocks < 4 or n_blocks % 2:
+            raise Exception('n_blocks must be even and at least 4')
+        self.R_d = R_d
+        self.t_block = t_block
+        self.n_blocks = n_blocks
+        self.tol = tol
+        self.n_sigma = n_sigma
+        self.r_peak = r_peak
+        self.t_min = t_min
+        self.t_blocks = []
+        self.blocks = []
+        self.t_stop = None
+        self._t_block_end = t_block
+        # Number of blocks there were when last judged.
+        self._n_judged = 0
+        self._start_block()
+
+    def _start_block(self):
+        self._sums = np.zeros([len(self.names)])
+        self._n_samples = 0
+        self._n_coll = 0
+        self._n_particle_steps = 0
+
+    def update(self, t, r, n_coll, n_steps=1):
+        """Add a sample of the positions, and the collisions since the last
+        sample.
+
+        Parameters
+        ----------
+        t: float
+            Current time.
+        r: array, shape (n, d)
+            Current particle positions.
+        n_coll: int
+            Total number of particles that collided in each step since the
+            last sample.
+        n_steps: int
+            Number of steps since the last sample.
+        """
+        r_mag = np.sqrt(np.sum(np.square(r), axis=-1)) / self.R_d
+        self._sums[0] += np.mean(r_mag)
+        self._sums[1] += np.mean(r_mag > self.r_peak)
+        self._n_samples += 1
+        self._n_coll += n_coll
+        self._n_particle_steps += n_steps * len(r)
+        if t >= self._t_block_end:
+            block = self._sums / self._n_samples
+            block[2] = self._n_coll / self._n_particle_steps
+            self.t_blocks.append(t)
+            self.blocks.append(block)
+            self._t_block_end += self.t_block
+            self._start_block()
+
+    def is_steady(self, t):
+        """Whether the run has reached a steady state. Once it has, the time
+        is recorded in `t_stop`."""
+        if self.t_stop is not None:
+            return True
+        if len(self.blocks) == self._n_judged:
+            return False
+        self._n_judged = len(self.blocks)
+        if t < self.t_min or len(self.blocks) < self.n_blocks:
+            return False
+        blocks = np.array(self.blocks[-self.n_blocks:])
+        half_1, half_2 = np.split(blocks, 2)
+        diff = np.abs(np.mean(half_2, axis=0) - np.mean(half_1, axis=0))
+        se = np.sqrt((np.var(half_1, axis=0, ddof=1) +
+                      np.var(half_2, axis=0, ddof=1)) / len(half_1))
+        if np.all(diff <= self.tol * np.abs(np.mean(blocks, axis=0)) +
+                  self.n_sigma * se):
+            self.t_stop = t
+            return True
+        return False
+
+    def save(self, fname):
+        """Save the block averages, and when and why the run stopped."""
+        if self.t_stop is None:
+            reason = 'reached t_max'
+        else:
+            reason = ('steady state within tolerance {} plus {} standard '
+                      'errors'.format(self.tol, self.n_sigma))
+        np.savez(fname, names=np.array(self.names),
+                 t_blocks=np.array(self.t_blocks),
+                 blocks=np.array(self.blocks).reshape([-1, len(self.names)]),
+                 steady=self.t_stop is not None,
+                 t_stop=np.nan if self.t_stop is None else self.t_stop,
+                 reason=reason)
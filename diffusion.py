@@ -5,6 +5,7 @@ from __future__ import print_function, division
 import numpy as np
 import scipy.constants
 from spatious import geom, rotation
+from mindrop import numerics
 
 
 def _spheroid_xi(p):
@@ -84,7 +85,25 @@ def stokes_einstein(drag, T):
     return scipy.constants.k * T / drag
 
 
-def rot_diff(v, D, dt, rng=None):
+def standard_normal(rng, out):
+    """Fill an array with samples from the standard normal distribution.
+
+    Parameters
+    ----------
+    rng: numpy.random.Generator or numpy.random.RandomState
+        Source of random numbers.
+    out: array
+        Array to fill.
+    """
+    try:
+        rng.standard_normal(out=out)
+    # Legacy random states cannot write into an existing array.
+    except TypeError:
+        out[...] = rng.standard_normal(out.shape)
+    return out
+
+
+def rot_diff(v, D, dt, rng=None, out=None, noise=None):
     """Get cartesian velocity vectors, after applying rotational diffusion.
 
     Parameters
@@ -95,6 +114,14 @@ def rot_diff(v, D, dt, rng=None):
         Rotational diffusion constant for each vector.
     dt: float
         Time interval over which rotational diffusion acts.
+    rng: numpy.random.Generator or streams.NoiseBlock, optional
+        Source of random numbers. Defaults to numpy's global random state.
+    out: array, shape of v, optional
+        Array in which to put the result. May be `v` itself.
+    noise: array, shape (n, d * (d - 1) / 2), optional
+        Scratch array for the random rotation angles. If not given, they
+        are taken straight from `rng`, which may be a
+        `streams.NoiseBlock`.
 
     Returns
     -------
@@ -114,11 +141,26 @@ def rot_diff(v, D, dt, rng=None):
         pass
     dim = v.shape[-1]
     dof = dim * (dim - 1) // 2
-    th = np.sqrt(2.0 * D * dt) * rng.standard_normal((v.shape[0], dof))
-    return rotation.rotate(v, th)
-
-
-def diff(r, D, dt, rng=None):
+    if noise is None:
+        th = rng.standard_normal([v.shape[0], dof])
+    else:
+        th = standard_normal(rng, noise)
+    th *= np.sqrt(2.0 * D * dt)
+    if dim != 3:
+        if out is None:
+            return rotation.rotate(v, th)
+        out[...] = rotation.rotate(v, th)
+        return out
+    # Rotate in place with the compiled kernel, without building matrices.
+    if out is None:
+        out = v.copy()
+    elif out is not v:
+        out[...] = v
+    numerics.rotate(out, th)
+    return out
+
+
+def diff(r, D, dt, rng=None, out=None, noise=None):
     """Get cartesian position vectors, after applying translational
     diffusion.
 
@@ -130,6 +172,13 @@ def diff(r, D, dt, rng=None):
         Translational diffusion constant for each vector.
     dt: float
         Time interval over which translational diffusion acts.
+    rng: numpy.random.Generator or streams.NoiseBlock, optional
+        Source of random numbers. Defaults to numpy's global random state.
+    out: array, shape of r, optional
+        Array in which to put the result. May be `r` itself.
+    noise: array, shape of r, optional
+        Scratch array for the random displacements. If not given, they are
+        taken straight from `rng`, which may be a `streams.NoiseBlock`.
 
     Returns
     -------
@@ -138,6 +187,14 @@ def diff(r, D, dt, rng=None):
     """
     if rng is None:
         rng = np.random
+    if out is None:
+        out = np.empty_like(r)
     if dt == 0.0:
-        return r.copy()
-    return r + np.sqrt(2.0 * D * dt) * rng.standard_normal(r.shape)
+        out[...] = r
+        return out
+    if noise is None:
+        dr = rng.standard_normal(r.shape)
+    else:
+        dr = standard_normal(rng, noise)
+    dr *= np.sqrt(2.0 * D * dt)
+    return np.add(r, dr, out=out)
@@ -0,0 +1,140 @@
+"""
+Functions relating to measuring where a run spends its time.
+"""
+from __future__ import print_function, division
+import time
+import numpy as np
+
+
+class Instruments(object):
+    """Cumulative wall time spent in each phase of a run, and counts of
+    events, logged every so often.
+
+    Phases are timed by laps: each call to `lap` charges the time since the
+    previous one to the phase named, so a step's phases are timed by calling
+    it once at the end of each.
+
+    An instruments object can be pickled, such as in a checkpoint. Time
+    between pickling and calling `restart` is not counted.
+
+    Parameters
+    ----------
+    t_max: float
+        Simulation time at which the run will finish, from which to estimate
+        the time left.
+    log_every: float
+        Wall time, in seconds, between log lines.
+    fname: str, optional
+        File to append log lines to. If not given, print them.
+    """
+
+    def __init__(self, t_max, log_every=60.0, fname=None):
+        self.t_max = t_max
+        self.log_every = log_every
+        self.fname = fname
+        self.phases = []
+        self.times = {}
+        self.counters = []
+        self.counts = {}
+        self.steps = 0
+        self.wall = 0.0
+        self.restart()
+
+    def restart(self, t=0.0):
+        """Start timing from now, such as at the start of a run, or after
+        resuming it at time `t`."""
+        self._last = time.time()
+        self._last_log = self._last
+        self._t_start = t
+        self._steps_start = self.steps
+        self._wall_start = self.wall
+
+    def lap(self, name):
+        """Charge the time since the last lap to a phase."""
+        now = time.time()
+        if name not in self.times:
+            self.phases.append(name)
+            self.times[name] = 0.0
+        self.times[name] += now - self._last
+        self.wall += now - self._last
+        self._last = now
+
+    def count(self, name, k=1):
+        """Add to a counter."""
+        if name not in self.counts:
+            self.counters.append(name)
+            self.counts[name] = 0
+        self.counts[name] += k
+
+    def step(self, t, k=1):
+        """Record that some steps have been taken, and log if it is time.
+
+        Parameters
+        ----------
+        t: float
+            Current time.
+        k: int
+            Number of steps.
+        """
+        self.steps += k
+        if self._last - self._last_log >= self.log_every:
+            self.log(t)
+            self._last_log = self._last
+
+    def rates(self, t):
+        """Steps per second of wall time, and estimated wall time left in
+        seconds, since the last restart."""
+        wall = self.wall - self._wall_start
+        if wall <= 0.0 or t <= self._t_start:
+            return np.nan, np.nan
+        steps_per_sec = (self.steps - self._steps_start) / wall
+        eta = max(self.t_max - t, 0.0) * wall / (t - self._t_start)
+        return steps_per_sec, eta
+
+    def log(self, t):
+        """Log the rates, and the fraction of time spent in each phase."""
+        steps_per_sec, eta = self.rates(t)
+        fields = ['t={:g}'.format(t), 'steps={}'.format(self.steps),
+                  'steps/s={:.1f}'.format(steps_per_sec),
+                  'eta={:.0f}s'.format(eta)]
+        for name in self.phases:
+            fields.append('{}={:.1%}'.format(name,
+                                             self.times[name] / self.wall))
+        for name in self.counters:
+            fields.append('{}={}'.format(name, self.counts[name]))
+        line = ' '.join(fields)
+        if self.fname is None:
+            print(line)
+        else:
+            with open(self.fname, 'a') as f:
+                f.write(line + '\n')
+
+    def save(self, fname):
+        """Save the phase times, counts and rates."""
+        np.savez(fname, phases=np.array(self.phases),
+                 times=np.array([self.times[p] for p in self.phases]),
+                 counters=np.array(self.counters),
+                 counts=np.array([self.counts[c] for c in self.counters],
+                                 dtype=np.int64),
+                 steps=self.steps, wall=self.wall,
+                 steps_per_sec=self.steps / self.wall if self.wall else np.nan)
+
+
+class NullInstruments(object):
+    """Stands in for `Instruments` when a run is not instrumented, at the
+    cost of a method call per phase."""
+
+    def restart(self, t=0.0):
+        pass
+
+    def lap(self, name):
+        pass
+
+    def count(self, name, k=1):
+        pass
+
+    def step(self, t, k=1):
+        pass
+
+
+null = NullInstruments()
@@ -1,17 +1,23 @@
 from __future__ import print_function, division
 import os
+import pickle
 import numpy as np
-from spatious import geom, vector
+from spatious import vector
 from ciabatta import fileio
-from mindrop import numerics, diffusion
+from mindrop import (numerics, diffusion, neighbours, scattering, streams,
+                     trajectory, accumulators, instruments)
 
 
 def spherocylinder_distance(R, l, a):
     return np.sqrt((R - a) ** 2 - (l / 2.0) ** 2)
 
 
-def collisions(r, u, l, R, R_d):
-    return geom.spherocylinder_intersection(r, u, l, R, L=2.2 * R_d)
+def collisions(r, u, l, R, R_d, subset=None, neighbs=None):
+    if neighbs is None:
+        i, j = neighbours.candidate_pairs(r, 2.0 * R_d, l + 2.0 * R, subset)
+    else:
+        i, j = neighbs.pairs(r, u, subset)
+    return numerics.spherocylinder_intersection(r, u, l, R, i, j)
 
 
 def obstructed(r, u, l, R, R_d):
@@ -19,27 +25,43 @@ def obstructed(r, u, l, R, R_d):
     return r_rad_sq > (R_d - R) ** 2
 
 
-def do_hard_core(r, u, l, R, R_d, r_old, u_old):
-    # Droplet
+def do_droplet(r, u, l, R, R_d):
     r_rad = np.sqrt(numerics.spherocylinder_radial_distance_sq(r, u, l, R,
                                                                R_d))
     overlap = r_rad - (R_d - R)
     c_drop = overlap > 0.0
 
-    u_r = vector.vector_unit_nonull(r[c_drop])
-    r[c_drop] = u_r * (vector.vector_mag(r[c_drop]) -
-                       overlap[c_drop])[:, np.newaxis]
+    if np.any(c_drop):
+        u_r = vector.vector_unit_nonull(r[c_drop])
+        r[c_drop] = u_r * (vector.vector_mag(r[c_drop]) -
+                           overlap[c_drop])[:, np.newaxis]
+
+
+def do_hard_core(r, u, l, R, R_d, r_old, u_old, neighbs=None, reverts=None,
+                 align=False, inst=instruments.null):
+    # Droplet, in one pass equivalent to `do_alignment` if aligning,
+    # followed by `do_droplet`.
+    numerics.droplet_wall(r, u, l, R, R_d, align)
+    inst.lap('wall')
 
     # Neighbours
-    reverts = np.zeros([len(r)], dtype=np.bool)
+    if reverts is None:
+        reverts = np.zeros([len(r)], dtype=np.bool)
+    c_neighb = None
     while True:
-        # Neighbour check
-        c_neighb = collisions(r, u, l, R, R_d)
+        # Neighbour check. Only particles just reverted can have changed
+        # collision state, so only they need to be checked again.
+        c_neighb = collisions(r, u, l, R, R_d, subset=c_neighb,
+                              neighbs=neighbs)
 
+        inst.count('hard_core_iterations')
         if not np.any(c_neighb):
             break
-        reverts += c_neighb
-        r[c_neighb], u[c_neighb] = r_old[c_neighb], u_old[c_neighb]
+        inst.count('reverts', np.count_nonzero(c_neighb))
+        reverts |= c_neighb
+        np.copyto(r, r_old, where=c_neighb[:, np.newaxis])
+        np.copyto(u, u_old, where=c_neighb[:, np.newaxis])
+    inst.lap('hard_core')
     return reverts
 
 
@@ -55,87 +77,430 @@ def do_alignment(r, u, l, R, R_d):
     r[c_drop] = u_r * spherocylinder_distance(R_d, l, R)
 
 
-def dropsim(n, v, l, R, D, Dr, R_d, dim, t_max, dt, out, every, Dr_c,
-            align=True, tracking=False):
-    if out is not None:
-        fileio.makedirs_safe(out)
-        fileio.makedirs_soft('%s/dyn' % out)
-
-    r = np.random.uniform(-R_d, R_d, size=[n, dim])
-    u = vector.sphere_pick(dim, n)
+def pack_sequential(n, l, R, R_d, dim, rng):
+    r = rng.uniform(-R_d, R_d, size=[n, dim])
+    u = streams.sphere_pick(rng, dim, n)
 
     for i in range(n):
         while True:
-            r[i] = np.random.uniform(-R_d, R_d, dim)
-            u[i] = vector.sphere_pick(dim)
+            r[i] = rng.uniform(-R_d, R_d, dim)
+            u[i] = streams.sphere_pick(rng, dim)
             if obstructed(r[np.newaxis, i], u[np.newaxis, i], l, R, R_d):
                 continue
             if i > 0 and np.any(collisions(r[:i + 1], u[:i + 1], l, R, R_d)):
                 continue
             break
+    return r, u
 
-    if out is not None:
-        np.savez(os.path.join(out, 'static'), l=l, R=R, R_d=R_d)
 
-    if tracking:
-        t_scat = np.ones([n]) * np.inf
-        r_scat = r.copy()
-        t_relax = R_d / v
-        t_scats, r_scats_1, r_scats_2 = [], [], []
+def pack_random(n, l, R, R_d, dim, rng):
+    # Random sequential addition, in batches. A candidate is kept if it
+    # overlaps neither a placed particle nor an earlier candidate in its
+    # batch. Batches are sized from the previous batch's acceptance rate.
+    r = np.empty([0, dim])
+    u = np.empty([0, dim])
+    n_try = n
+    while len(r) < n:
+        n_placed = len(r)
+        r_new = rng.uniform(-R_d, R_d, size=[n_try, dim])
+        u_new = streams.sphere_pick(rng, dim, n_try)
+        free = np.logical_not(obstructed(r_new, u_new, l, R, R_d))
+        r_all = np.concatenate([r, r_new[free]])
+        u_all = np.concatenate([u, u_new[free]])
+
+        new = np.arange(len(r_all)) >= n_placed
+        i, j = neighbours.candidate_pairs(r_all, 2.0 * R_d, l + 2.0 * R,
+                                          subset=new)
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        blocked = np.zeros([len(r_all)], dtype=np.bool)
+        # Test against placed particles first, then among what survives.
+        for pairs in (i < n_placed, i >= n_placed):
+            pairs &= np.logical_not(blocked[i] | blocked[j])
+            c = neighbours.spherocylinder_overlaps(r_all, u_all, l, R,
+                                                   i[pairs], j[pairs])
+            blocked[j[pairs][c]] = True
+        free = np.flatnonzero(np.logical_not(blocked[n_placed:]))
+        r = np.concatenate([r, r_all[n_placed + free[:n - n_placed]]])
+        u = np.concatenate([u, u_all[n_placed + free[:n - n_placed]]])
+
+        rate = max(len(free), 1) / n_try
+        n_try = int(min((n - len(r)) / rate, 10 * n)) + 1
+    return r, u
+
+
+def pack_lattice(n, l, R, R_d, dim, rng):
+    # Jittered cubic lattice. Centres at least `l + 2R` apart cannot overlap,
+    # and centres within `R_d - R - l / 2` of the origin cannot touch the
+    # wall, whatever the orientations.
+    sep_min = l + 2.0 * R
+    R_max = R_d - R - l / 2.0
+    a = 2.0 * R_max
+    while a >= sep_min:
+        jitter = (a - sep_min) / 2.0
+        R_site = R_max - np.sqrt(dim) * jitter
+        offset = rng.uniform(0.0, a, size=dim)
+        x = np.arange(-R_max - a, R_max + a, a)
+        sites = np.array(np.meshgrid(*[x] * dim)).reshape([dim, -1]).T
+        sites += offset
+        sites = sites[vector.vector_mag(sites) <= R_site]
+        if len(sites) >= n:
+            break
+        a *= 0.98
+    else:
+        raise Exception('Cannot fit {} particles on a lattice'.format(n))
+
+    r = sites[rng.permutation(len(sites))[:n]]
+    r += rng.uniform(-jitter, jitter, size=r.shape)
+    u = streams.sphere_pick(rng, dim, n)
+    return r, u
+
+
+packers = {
+    'sequential': pack_sequential,
+    'random': pack_random,
+    'lattice': pack_lattice,
+}
+
+
+def n_snapshots(t_max, dt, every):
+    # Number of snapshots a run will take, allowing for rounding in the
+    # time.
+    return int(np.ceil(t_max / dt)) // every + 1
+
+
+def save_checkpoint(out, state):
+    # Write to a temporary file first, so a run killed while writing still
+    # leaves the previous checkpoint intact.
+    fname = os.path.join(out, 'checkpoint.pkl')
+    with open(fname + '.tmp', 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(fname + '.tmp', fname)
+
+
+def flush_outputs(traj, tracker):
+    # Write out what a run reached, even if stepping failed.
+    if traj is not None:
+        traj.close()
+    if tracker is not None:
+        tracker.events.flush()
+
+
+def load_checkpoint(out):
+    fname = os.path.join(out, 'checkpoint.pkl')
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+
+def run_compiled(r, u, v, l, R, D, Dr, R_d, t_max, dt, traj, every, Dr_c,
+                 align, rng, tracker=None, acc=None, monitor=None, block=1000,
+                 i=0, t=0.0, checkpoint=None, checkpoint_every=None,
+                 inst=instruments.null):
+    # Step in compiled blocks, with noise drawn for `block` steps at a time.
+    # Only suited to small systems, as neighbours are found by testing all
+    # pairs. Checkpoints are only taken between blocks, so that the random
+    # state is all that is needed to carry on. Phases within a block cannot
+    # be timed apart, so are all charged to `steps`.
+    n, dim = r.shape
+    if checkpoint_every:
+        block = min(block, checkpoint_every)
+    noise_rot = np.empty([block, n, dim * (dim - 1) // 2])
+    noise_trans = np.empty([block, n, dim])
+    noise_tumble = np.empty([block, n, dim])
+    r_snap, u_snap = np.empty_like(r), np.empty_like(u)
+    if tracker is None:
+        t_scat, r_scat = np.empty([n]), np.empty([n, dim])
+        n_ev_max = 0
+    else:
+        t_scat, r_scat = tracker.t_scat, tracker.r_scat
+        n_ev_max = block * n
+    ev_i, ev_t = np.empty([n_ev_max], dtype=np.intp), np.empty([n_ev_max])
+    ev_r1, ev_r2 = np.empty([n_ev_max, dim]), np.empty([n_ev_max, dim])
+    acc_args = {} if acc is None else acc.kernel_args()
+    n_coll = np.zeros([1], dtype=np.int64)
+
+    i_checkpoint = i
+    k = block
+    while t < t_max:
+        if k == block:
+            if checkpoint_every and i - i_checkpoint >= checkpoint_every:
+                checkpoint(i, t)
+                i_checkpoint = i
+                inst.lap('checkpoint')
+            for noise in (noise_rot, noise_trans, noise_tumble):
+                diffusion.standard_normal(rng, noise)
+            k = 0
+            inst.lap('noise')
+        k_done, i, t, n_ev, snapped = numerics.run_steps(
+            r, u, v, l, R, D, Dr, R_d, dt, Dr_c, align, i, t, t_max,
+            every if traj is not None else 0,
+            noise_rot[k:], noise_trans[k:], noise_tumble[k:], r_snap, u_snap,
+            t_scat, r_scat, R_d / v if tracker is None else tracker.t_relax,
+            tracker is not None, tracker is not None and tracker.always,
+            ev_i, ev_t, ev_r1, ev_r2, n_coll=n_coll, **acc_args)
+        k += k_done
+        inst.lap('steps')
+        if tracker is not None:
+            tracker.events.extend(ev_i[:n_ev], ev_t[:n_ev], ev_r1[:n_ev],
+                                  ev_r2[:n_ev])
+            inst.lap('tracking')
+        if snapped:
+            traj.append(t, r_snap, u_snap)
+            inst.lap('output')
+        inst.count('collisions', n_coll[0])
+        inst.step(t, k_done)
+        if monitor is not None:
+            monitor.update(t, r, n_coll[0], k_done)
+            inst.lap('monitor')
+        n_coll[0] = 0
+        if monitor is not None and monitor.is_steady(t):
+            break
+    return i, t
+
+
+def run_python(r, u, v, l, R, D, Dr, R_d, t_max, dt, traj, every, Dr_c,
+               align, rng, neighbs, tracker=None, acc=None, monitor=None,
+               i=0, t=0.0, checkpoint=None, checkpoint_every=None,
+               inst=instruments.null):
+    # Step one at a time in NumPy, with neighbours found through `neighbs`.
+    n, dim = r.shape
+    # Buffers reused every step.
+    r_old, u_old = np.empty_like(r), np.empty_like(u)
+    dr_swim = np.empty_like(r)
+    c_neighb = np.zeros([n], dtype=np.bool)
 
-    i = 0
-    t = 0
     while t < t_max:
+        c_neighb[:] = False
+
         if Dr:
-            r_old = r.copy()
-            u_old = u.copy()
-            u = diffusion.rot_diff(u, Dr, dt)
-            c_neighb = do_hard_core(r, u, l, R, R_d, r_old, u_old)
+            np.copyto(r_old, r)
+            np.copyto(u_old, u)
+            diffusion.rot_diff(u, Dr, dt, rng, out=u)
+            inst.lap('rot_diff')
+            do_hard_core(r, u, l, R, R_d, r_old, u_old, neighbs, c_neighb,
+                         inst=inst)
 
         if D:
-            r_old = r.copy()
-            u_old = u.copy()
-            r = diffusion.diff(r, D, dt)
-            c_neighb += do_hard_core(r, u, l, R, R_d, r_old, u_old)
-
-        r_old = r.copy()
-        u_old = u.copy()
-        r += v * u * dt
-        if align:
-            do_alignment(r, u, l, R, R_d)
-        c_neighb += do_hard_core(r, u, l, R, R_d, r_old, u_old)
+            np.copyto(r_old, r)
+            np.copyto(u_old, u)
+            diffusion.diff(r, D, dt, rng, out=r)
+            inst.lap('diff')
+            do_hard_core(r, u, l, R, R_d, r_old, u_old, neighbs, c_neighb,
+                         inst=inst)
+
+        np.copyto(r_old, r)
+        np.copyto(u_old, u)
+        np.multiply(u, v * dt, out=dr_swim)
+        r += dr_swim
+        inst.lap('swim')
+        do_hard_core(r, u, l, R, R_d, r_old, u_old, neighbs, c_neighb,
+                     align=align, inst=inst)
 
         i += 1
         t += dt
 
-        if out is not None and not i % every:
-            out_fname = '%010f' % t
-            np.savez(os.path.join(out, 'dyn', out_fname), r=r, u=u)
+        if traj is not None and not i % every:
+            traj.append(t, r, u)
+
+        if acc is not None:
+            acc.update(t, r)
+        inst.lap('output')
 
         if Dr_c:
-            r_old = r.copy()
-            u_old = u.copy()
+            np.copyto(r_old, r)
+            np.copyto(u_old, u)
             if np.isfinite(Dr_c):
-                u[c_neighb] = diffusion.rot_diff(u[c_neighb], Dr_c, dt)
+                u[c_neighb] = diffusion.rot_diff(u[c_neighb], Dr_c, dt, rng)
             else:
-                u[c_neighb] = vector.sphere_pick(dim, c_neighb.sum())
-            c_neighb += do_hard_core(r, u, l, R, R_d, r_old, u_old)
+                u[c_neighb] = streams.sphere_pick(rng, dim, c_neighb.sum())
+            inst.lap('tumble')
+            do_hard_core(r, u, l, R, R_d, r_old, u_old, neighbs, c_neighb,
+                         inst=inst)
+
+        if tracker is not None:
+            tracker.update(t, r, c_neighb)
+            inst.lap('tracking')
+
+        inst.count('collisions', np.count_nonzero(c_neighb))
+        inst.step(t)
+        if monitor is not None:
+            monitor.update(t, r, np.count_nonzero(c_neighb))
+            inst.lap('monitor')
+            if monitor.is_steady(t):
+                break
+
+        # Last, so that everything done this step is in the checkpoint.
+        if checkpoint_every and not i % checkpoint_every:
+            checkpoint(i, t)
+            inst.lap('checkpoint')
+    return i, t
 
+
+def dropsim(n, v, l, R, D, Dr, R_d, dim, t_max, dt, out, every, Dr_c,
+            align=True, tracking=False, skin=None, pack='sequential',
+            engine='python', checkpoint_every=None, resume=False, rng=None,
+            noise_thread=False, write_thread=True, summary=None,
+            steady=None, instrument=None):
+    if engine not in ('python', 'compiled'):
+        raise Exception('Unknown engine: {}'.format(engine))
+    if engine == 'compiled' and numerics.backend != 'compiled':
+        raise Exception('The compiled engine needs the compiled numerics')
+    if pack not in packers:
+        raise Exception('Unknown packing mode: {}'.format(pack))
+    if out is None and (checkpoint_every or resume):
+        raise Exception('Checkpoints need an output directory')
+    if out is not None:
+        # A resumed run's directory already exists, and is meant to.
+        if resume:
+            fileio.makedirs_soft(out)
+        else:
+            fileio.makedirs_safe(out)
+        fileio.makedirs_soft('%s/dyn' % out)
+
+    state = load_checkpoint(out) if resume else None
+    if state is None:
+        rng = streams.make_rng(rng)
+        r, u = packers[pack](n, l, R, R_d, dim, rng)
+        if engine == 'python':
+            # Stepping only needs normal samples, so draw them in blocks.
+            rng = streams.NoiseBlock(rng, background=noise_thread)
+
+        if skin is None:
+            skin = R + l / 2.0
+        neighbs = neighbours.VerletList(2.0 * R_d, l + 2.0 * R, skin, l)
+
+        tracker = None
         if tracking:
-            for i_n in range(n):
-                # If tracking finished:
-                if t > t_scat[i_n]:
-                    t_scats.append(t)
-                    r_scats_1.append(r_scat[i_n])
-                    r_scats_2.append(r[i_n])
-                    # Reset tracking.
-                    t_scat[i_n] = np.inf
-            for i_n in range(n):
-                # If not already tracking, and collision happens:
-                if c_neighb[i_n] or n == 1:
-                    if t_scat[i_n] == np.inf:
-                        # Start tracking.
-                        t_scat[i_n] = t + t_relax
-                        r_scat[i_n] = r[i_n].copy()
+            tracker = scattering.Tracker(
+                r, t_relax=R_d / v, always=n == 1,
+                fname=None if out is None else os.path.join(out,
+                                                            'tracking.npy'))
+
+        acc = None
+        if summary is not None:
+            acc = accumulators.RadialAccumulator(n, R_d, **summary)
+
+        monitor = None
+        if steady is not None:
+            monitor = accumulators.SteadyStateMonitor(R_d, **steady)
+
+        inst = None
+        if instrument is not None:
+            inst = instruments.Instruments(
+                t_max, instrument,
+                None if out is None else os.path.join(out, 'instruments.log'))
+
+        traj = None
+        if out is not None:
+            traj = trajectory.Trajectory(os.path.join(out, 'dyn'), n, dim,
+                                         n_snapshots(t_max, dt, every))
+            if write_thread:
+                traj = trajectory.TrajectoryWriter(traj)
+
+        i = 0
+        t = 0
+    else:
+        r, u, neighbs, tracker = (state['r'], state['u'], state['neighbs'],
+                                  state['tracker'])
+        i, t, rng, traj = state['i'], state['t'], state['rng'], state['traj']
+        acc, monitor, inst = state['acc'], state['monitor'], state['inst']
+        if inst is not None:
+            inst.t_max = t_max
+
+    if out is not None:
+        np.savez(os.path.join(out, 'static'), l=l, R=R, R_d=R_d)
+
+    def checkpoint(i, t):
+        save_checkpoint(out, dict(r=r, u=u, neighbs=neighbs, tracker=tracker,
+                                  acc=acc, monitor=monitor, inst=inst, i=i,
+                                  t=t, rng=rng, traj=traj))
+
+    run_inst = instruments.null if inst is None else inst
+    run_inst.restart(t)
+
+    try:
+        if engine == 'compiled':
+            i, t = run_compiled(r, u, v, l, R, D, Dr, R_d, t_max, dt, traj,
+                                every, Dr_c, align, rng, tracker, acc,
+                                monitor, i=i, t=t, checkpoint=checkpoint,
+                                checkpoint_every=checkpoint_every,
+                                inst=run_inst)
+        else:
+            i, t = run_python(r, u, v, l, R, D, Dr, R_d, t_max, dt, traj,
+                              every, Dr_c, align, rng, neighbs, tracker, acc,
+                              monitor, i=i, t=t, checkpoint=checkpoint,
+                              checkpoint_every=checkpoint_every,
+                              inst=run_inst)
+    finally:
+        flush_outputs(traj, tracker)
+    if tracker is not None:
+        tracker.events.close()
+    if acc is not None and out is not None:
+        acc.save(os.path.join(out, 'summary'))
+    if monitor is not None and out is not None:
+        monitor.save(os.path.join(out, 'steady'))
+    if inst is not None:
+        inst.log(t)
+        if out is not None:
+            inst.save(os.path.join(out, 'instruments'))
+    if out is not None:
+        # Written last, to mark the run as finished.
+        np.savez(os.path.join(out, 'done'), i=i, t=t)
+
+
+def dropsim_batch(replicas, n, v, l, R, D, Dr, R_d, dim, t_max, dt, out,
+                  every, Dr_c, align=True, tracking=False, pack='sequential',
+                  rng=None):
+    # Simulate many independent droplets together. State is held with shape
+    # (replicas, n, dim), and stepped by `run_python` as one system through
+    # flattened views, with a pair list so that each replica's particles
+    # only collide with each other.
+    # Each replica is packed from its own stream, spawned from `rng`, so its
+    # starting state is the same whatever the number of replicas. Stepping
+    # draws from one more stream shared by all replicas, so a replica's
+    # trajectory is only reproduced by rerunning the whole batch.
+    if pack not in packers:
+        raise Exception('Unknown packing mode: {}'.format(pack))
+    if out is not None:
+        outs = [os.path.join(out, 'replica_{}'.format(b))
+                for b in range(replicas)]
+        for out_b in outs:
+            fileio.makedirs_safe(out_b)
+            fileio.makedirs_soft('%s/dyn' % out_b)
+
+    seeds = streams.spawn(rng, replicas + 1)
+    r = np.empty([replicas, n, dim])
+    u = np.empty([replicas, n, dim])
+    for b in range(replicas):
+        r[b], u[b] = packers[pack](n, l, R, R_d, dim,
+                                   streams.make_rng(seeds[b]))
+    rng = streams.NoiseBlock(streams.make_rng(seeds[-1]))
+    r_flat, u_flat = r.reshape([-1, dim]), u.reshape([-1, dim])
+
+    traj = None
+    if out is not None:
+        trajs = []
+        for out_b in outs:
+            np.savez(os.path.join(out_b, 'static'), l=l, R=R, R_d=R_d)
+            trajs.append(trajectory.Trajectory(
+                os.path.join(out_b, 'dyn'), n, dim,
+                n_snapshots(t_max, dt, every)))
+        traj = trajectory.ReplicaTrajectories(trajs)
+
+    neighbs = neighbours.PairList(*neighbours.replica_pairs(replicas, n))
+
+    tracker = None
     if tracking:
-        np.savez(os.path.join(out, 'tracking'), t=t_scats, r1=r_scats_1, r2=r_scats_2)
+        tracker = scattering.Tracker(r_flat, t_relax=R_d / v, always=n == 1)
+
+    try:
+        run_python(r_flat, u_flat, v, l, R, D, Dr, R_d, t_max, dt, traj,
+                   every, Dr_c, align, rng, neighbs, tracker)
+    finally:
+        flush_outputs(traj, tracker)
+    if tracker is not None and out is not None:
+        replica = np.repeat(np.arange(replicas), n)
+        for b, out_b in enumerate(outs):
+            tracker.save(os.path.join(out_b, 'tracking'),
+                         particles=replica == b)
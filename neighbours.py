@@ -0,0 +1,282 @@
+"""
+Functions relating to finding neighbouring particles.
+"""
+from __future__ import print_function, division
+import itertools
+import numpy as np
+
+# Below this many particles, testing all pairs is cheaper than binning.
+n_brute = 32
+
+
+def _shell_offsets(dim, half):
+    offsets = np.array(list(itertools.product([-1, 0, 1], repeat=dim)))
+    if half:
+        # Keep the zero offset and one of each pair of opposite offsets.
+        first = np.array([o[np.flatnonzero(o)[0]] if np.any(o) else 1
+                          for o in offsets])
+        offsets = offsets[first > 0]
+    return offsets
+
+
+def cell_list(r, L, r_c):
+    """Bin position vectors into a cubic grid of cells.
+
+    Parameters
+    ----------
+    r: array, shape (n, d)
+        Cartesian position vectors in d dimensions.
+    L: float
+        Side length of the cube, centred on the origin, spanned by the grid.
+        Vectors outside the cube are binned into the nearest edge cell.
+    r_c: float
+        Minimum cell side length.
+
+    Returns
+    -------
+    inds: integer array, shape (n, d)
+        Cell index of each vector along each axis.
+    order: integer array, shape (n,)
+        Vector indices, sorted by cell.
+    starts: integer array, shape (m ** d,)
+        Position in `order` of the first vector in each cell.
+    counts: integer array, shape (m ** d,)
+        Number of vectors in each cell.
+    m: int
+        Number of cells along each axis.
+    """
+    dim = r.shape[-1]
+    m = max(int(np.floor(L / r_c)), 1)
+    inds = np.floor((r + L / 2.0) * (m / L)).astype(np.intp)
+    np.clip(inds, 0, m - 1, out=inds)
+    cell = np.ravel_multi_index(inds.T, (m,) * dim)
+    order = np.argsort(cell, kind='mergesort')
+    counts = np.bincount(cell, minlength=m ** dim)
+    starts = np.cumsum(counts) - counts
+    return inds, order, starts, counts, m
+
+
+def _brute_pairs(n, subset):
+    if subset is None:
+        return np.triu_indices(n, 1)
+    i_s = np.flatnonzero(subset)
+    i = np.repeat(i_s, n)
+    j = np.tile(np.arange(n), len(i_s))
+    keep = (i != j) & ((i < j) | ~subset[j])
+    return i[keep], j[keep]
+
+
+def candidate_pairs(r, L, r_c, subset=None):
+    """Find the pairs of position vectors that may be within a distance of
+    each other, using a cell list.
+
+    Parameters
+    ----------
+    r: array, shape (n, d)
+        Cartesian position vectors in d dimensions.
+    L: float
+        Side length of the cube, centred on the origin, enclosing the vectors.
+    r_c: float
+        Cut-off distance. Every pair closer than this is returned,
+        along with some further apart.
+    subset: bool array, shape (n,), optional
+        If given, only return pairs involving at least one of these vectors.
+
+    Returns
+    -------
+    i, j: integer arrays, shape (p,)
+        Indices of each candidate pair. Each pair appears once.
+    """
+    n = len(r)
+    if n < n_brute:
+        return _brute_pairs(n, subset)
+    inds, order, starts, counts, m = cell_list(r, L, r_c)
+    if m < 3:
+        return _brute_pairs(n, subset)
+    dim = r.shape[-1]
+    if subset is None:
+        i_s = np.arange(n)
+    else:
+        i_s = np.flatnonzero(subset)
+
+    i_all, j_all = [], []
+    for offset in _shell_offsets(dim, half=subset is None):
+        neighb = inds[i_s] + offset
+        valid = np.all((neighb >= 0) & (neighb < m), axis=-1)
+        cell = np.ravel_multi_index(neighb[valid].T, (m,) * dim)
+        count = counts[cell]
+        i = np.repeat(i_s[valid], count)
+        # Position of each member within its cell's run of `order`.
+        within = np.arange(len(i)) - np.repeat(np.cumsum(count) - count, count)
+        j = order[np.repeat(starts[cell], count) + within]
+        if not np.any(offset):
+            keep = i != j if subset is not None else i < j
+            i, j = i[keep], j[keep]
+        i_all.append(i)
+        j_all.append(j)
+    i, j = np.concatenate(i_all), np.concatenate(j_all)
+    if subset is not None:
+        # Pairs within the subset have been found from both ends.
+        keep = (i < j) | ~subset[j]
+        i, j = i[keep], j[keep]
+    return i, j
+
+
+def replica_pairs(replicas, n):
+    """Find all pairs within each of several independent systems, whose
+    particles are stored one system after another.
+
+    Parameters
+    ----------
+    replicas: int
+        Number of systems.
+    n: int
+        Number of particles in each system.
+
+    Returns
+    -------
+    i, j: integer arrays, shape (replicas * n * (n - 1) / 2,)
+        Indices of each pair.
+    """
+    i, j = np.triu_indices(n, 1)
+    offsets = n * np.arange(replicas)[:, np.newaxis]
+    return (offsets + i).ravel(), (offsets + j).ravel()
+
+
+def spherocylinder_overlaps(r, u, l, R, i, j):
+    """Test pairs of spherocylinders for overlap.
+
+    Uses the closest points between each pair's line segments.
+
+    Parameters
+    ----------
+    r: array, shape (n, d)
+        Centre positions.
+    u: array, shape (n, d)
+        Unit orientation vectors.
+    l: float
+        Segment length.
+    R: float
+        Radius.
+    i, j: integer arrays, shape (p,)
+        Indices of each pair to test.
+
+    Returns
+    -------
+    c: bool array, shape (p,)
+        Whether each pair overlaps.
+    """
+    l_half = l / 2.0
+    w = r[i] - r[j]
+    u_i, u_j = u[i], u[j]
+    b = np.sum(u_i * u_j, axis=-1)
+    u_i_w = np.sum(u_i * w, axis=-1)
+    u_j_w = np.sum(u_j * w, axis=-1)
+    denom = 1.0 - b ** 2
+    parallel = denom < 1e-10
+    s = np.where(parallel, 0.0,
+                 (b * u_j_w - u_i_w) / np.where(parallel, 1.0, denom))
+    s = np.clip(s, -l_half, l_half)
+    t = np.clip(s * b + u_j_w, -l_half, l_half)
+    s = np.clip(t * b - u_i_w, -l_half, l_half)
+    sep = w + s[:, np.newaxis] * u_i - t[:, np.newaxis] * u_j
+    return np.sum(np.square(sep), axis=-1) < (2.0 * R) ** 2
+
+
+def pairs_to_mask(n, i, j, c):
+    """Flag every particle that belongs to at least one flagged pair."""
+    mask = np.zeros([n], dtype=np.bool)
+    mask[i[c]] = True
+    mask[j[c]] = True
+    return mask
+
+
+class PairList(object):
+    """A fixed list of candidate pairs.
+
+    Parameters
+    ----------
+    i, j: integer arrays, shape (p,)
+        Indices of each candidate pair.
+    """
+
+    def __init__(self, i, j):
+        self.i = i
+        self.j = j
+
+    def pairs(self, r, u, subset=None):
+        """Get candidate pairs.
+
+        Parameters
+        ----------
+        r: array, shape (n, d)
+            Centre positions.
+        u: array, shape (n, d)
+            Unit orientation vectors.
+        subset: bool array, shape (n,), optional
+            If given, only return pairs involving at least one of these
+            particles.
+
+        Returns
+        -------
+        i, j: integer arrays, shape (p,)
+            Indices of each candidate pair.
+        """
+        if subset is None:
+            return self.i, self.j
+        keep = subset[self.i] | subset[self.j]
+        return self.i[keep], self.j[keep]
+
+
+class VerletList(PairList):
+    """Candidate pairs of spherocylinders, padded by a skin distance so that
+    they stay valid while the particles move a little.
+
+    The list is only rebuilt once some particle's segment end might have
+    moved by more than half the skin since the last build.
+
+    Parameters
+    ----------
+    L: float
+        Side length of the cube, centred on the origin, enclosing the
+        particles.
+    r_c: float
+        Cut-off distance between particle centres.
+    skin: float
+        Extra distance added to the cut-off.
+    l: float
+        Segment length, used to convert changes in orientation into
+        displacements of the segment ends.
+    """
+
+    def __init__(self, L, r_c, skin, l):
+        self.L = L
+        self.r_c = r_c
+        self.skin = skin
+        self.l = l
+        self.r_ref = None
+        self.u_ref = None
+        self.n_builds = 0
+
+    def build(self, r, u):
+        self.i, self.j = candidate_pairs(r, self.L, self.r_c + self.skin)
+        self.r_ref = r.copy()
+        self.u_ref = u.copy()
+        self.n_builds += 1
+
+    def max_displacement(self, r, u):
+        dr = np.sqrt(np.sum(np.square(r - self.r_ref), axis=-1))
+        du = np.sqrt(np.sum(np.square(u - self.u_ref), axis=-1))
+        return np.max(dr + (self.l / 2.0) * du)
+
+    def update(self, r, u):
+        if (self.r_ref is None or r.shape != self.r_ref.shape or
+                self.max_displacement(r, u) > self.skin / 2.0):
+            self.build(r, u)
+
+    def pairs(self, r, u, subset=None):
+        """Get candidate pairs for the current configuration, rebuilding the
+        list first if needed. See `PairList.pairs`.
+        """
+        self.update(r, u)
+        return PairList.pairs(self, r, u, subset)
@@ -0,0 +1,170 @@
+"""
+Functions relating to the numerical kernels that stepping spends most of its
+time in.
+
+The kernels come from `_numerics`, compiled from Cython by `setup.py`, when
+it has been built, and otherwise from the NumPy versions here, which give
+the same results in 2 or 3 dimensions, only more slowly. `run_steps`, which
+the compiled engine needs, has no NumPy version.
+
+Which to use can be chosen by setting the environment variable
+`MINDROP_NUMERICS` to `compiled` or `numpy` before import, or by calling
+`use` after. The one in use is named by `backend`. `set_num_threads` sets
+how many threads the compiled kernels use.
+"""
+from __future__ import print_function, division
+import os
+import numpy as np
+from mindrop import neighbours
+
+kernels = ('spherocylinder_radial_distance_sq', 'spherocylinder_intersection',
+           'droplet_wall', 'rotate', 'accumulate_radial', 'run_steps',
+           'set_num_threads')
+
+
+def _end_radial_distance_sq(r, u, l_half):
+    r_rad_1_sq = np.sum(np.square(r + u * l_half), axis=-1)
+    r_rad_2_sq = np.sum(np.square(r - u * l_half), axis=-1)
+    return np.maximum(r_rad_1_sq, r_rad_2_sq)
+
+
+def _spherocylinder_radial_distance_sq(r, u, l, R, R_d):
+    # Squared distance from the origin of the further segment end.
+    return _end_radial_distance_sq(r, u, l / 2.0)
+
+
+def _spherocylinder_intersection(r, u, l, R, i, j):
+    # Flag every particle in at least one overlapping pair.
+    c = neighbours.spherocylinder_overlaps(r, u, l, R, i, j)
+    return neighbours.pairs_to_mask(len(r), i, j, c)
+
+
+def _scale_nonnull(v, v_mag, scale):
+    # Scale each vector by its factor, setting those of zero magnitude to
+    # zero.
+    nonnull = v_mag > 0.0
+    v[nonnull] *= (scale[nonnull] / v_mag[nonnull])[:, np.newaxis]
+    v[~nonnull] = 0.0
+
+
+def _droplet_wall(r, u, l, R, R_d, align):
+    # Push spherocylinders that cross the wall back inside, first aligning
+    # them with it if asked. Returns how many crossed.
+    l_half, R_max = l / 2.0, R_d - R
+    r_rad_sq = _end_radial_distance_sq(r, u, l_half)
+    wall = np.flatnonzero(r_rad_sq > R_max ** 2)
+    if not len(wall):
+        return 0
+    r_w, u_w, r_rad_sq = r[wall], u[wall], r_rad_sq[wall]
+    r_mag = np.sqrt(np.sum(np.square(r_w), axis=-1))
+
+    if align:
+        # Project the orientation onto the wall's tangent plane,
+        # and make the spherocylinder touch the wall. Centres at the origin
+        # have no radial direction, so stay there.
+        r_mag_safe = np.where(r_mag > 0.0, r_mag, 1.0)[:, np.newaxis]
+        u_dot_u_r = np.sum(u_w * r_w / r_mag_safe, axis=-1)
+        u_w -= r_w / r_mag_safe * u_dot_u_r[:, np.newaxis]
+        u_mag = np.sqrt(np.sum(np.square(u_w), axis=-1))
+        nonnull = u_mag > 0.0
+        u_w[nonnull] /= u_mag[nonnull, np.newaxis]
+        r_touch = np.sqrt(R_max ** 2 - l_half ** 2)
+        _scale_nonnull(r_w, r_mag, np.full(len(r_w), r_touch))
+        r_rad_sq = _end_radial_distance_sq(r_w, u_w, l_half)
+        r_mag = np.full(len(r_w), r_touch)
+        u[wall] = u_w
+
+    # Push the spherocylinder back inside the wall.
+    push = r_rad_sq > R_max ** 2
+    r_push = r_w[push]
+    r_new_mag = r_mag[push] - (np.sqrt(r_rad_sq[push]) - R_max)
+    _scale_nonnull(r_push, r_mag[push], r_new_mag)
+    r_w[push] = r_push
+    r[wall] = r_w
+    return len(wall)
+
+
+def _rotate(u, th, th_scale=1.0):
+    # Rotate each vector in u, in place, by its angles in th * th_scale:
+    # about the axis th in 3D, or in the plane in 2D.
+    dim = u.shape[-1]
+    if dim == 2:
+        ang = th[:, 0] * th_scale
+        c, s = np.cos(ang), np.sin(ang)
+        u_0 = u[:, 0].copy()
+        u[:, 0] = c * u_0 - s * u[:, 1]
+        u[:, 1] = s * u_0 + c * u[:, 1]
+        return
+    if dim != 3:
+        raise Exception('Rotation only supports 2 or 3 dimensions')
+    ang = np.sqrt(np.sum(np.square(th), axis=-1))
+    rot = ang > 0.0
+    k = th[rot] / ang[rot, np.newaxis]
+    ang = ang[rot] * th_scale
+    u_r = u[rot]
+    c, s = np.cos(ang)[:, np.newaxis], np.sin(ang)[:, np.newaxis]
+    k_dot_u = np.sum(k * u_r, axis=-1)[:, np.newaxis]
+    u[rot] = u_r * c + np.cross(k, u_r) * s + k * k_dot_u * (1.0 - c)
+
+
+def _accumulate_radial(r, R_d, R_max, cos_theta_max, hemisphere, ns, ns_sum,
+                       ns_sq_sum, counts):
+    # Bin the radial distances of the particles within the sector, as
+    # `utils.dataset.Dataset` selects them, and add the histogram to the
+    # running sums.
+    r_mag = np.sqrt(np.sum(np.square(r), axis=-1))
+    z = r[:, -1]
+    valid = (r_mag <= R_d) & (np.abs(z) >= cos_theta_max * r_mag)
+    if hemisphere:
+        valid &= z >= 0.0
+    n_bins = len(ns)
+    b = (n_bins * r_mag[valid] / R_max).astype(np.intp)
+    ns[:] = np.bincount(b[b < n_bins], minlength=n_bins)
+    count = np.count_nonzero(valid)
+    counts[count] += 1
+    if count:
+        ns_sum += ns
+        ns_sq_sum += np.square(ns)
+
+
+def _run_steps(*args, **kwargs):
+    raise Exception('run_steps needs the compiled numerics, built with '
+                    'setup.py')
+
+
+def _set_num_threads(n):
+    # Nothing to set, as the NumPy kernels run on one thread.
+    pass
+
+
+def use(name):
+    """Choose which kernels to use.
+
+    Parameters
+    ----------
+    name: str
+        `compiled`, `numpy`, or `auto` for the compiled kernels if they have
+        been built, and otherwise NumPy.
+    """
+    global backend
+    if name not in ('compiled', 'numpy', 'auto'):
+        raise Exception('Unknown numerics backend: {}'.format(name))
+    module = None
+    if name != 'numpy':
+        try:
+            from mindrop import _numerics as module
+        except ImportError:
+            if name == 'compiled':
+                raise
+    if module is None:
+        for kernel in kernels:
+            globals()[kernel] = globals()['_' + kernel]
+        backend = 'numpy'
+    else:
+        for kernel in kernels:
+            globals()[kernel] = getattr(module, kernel)
+        backend = 'compiled'
+
+
+backend = None
+use(os.environ.get('MINDROP_NUMERICS', 'auto'))
@@ -1,20 +1,89 @@
-import model
+#!/usr/bin/env python
+import argparse
+import sweep
 
-# n_10_v_13.5_l_1.23_R_0.36_D_0.25_Dr_0.05_Rd_16.0_Drc_10
-v = 13.5
-l = 1.23
-R = 0.36
-D = 0.25
-Dr = 0.05
-R_d = 16.0
-dim = 3
-t_max = 10000.0
-dt = 0.01
-every = 100
-Dr_c = 10.0
-align = True
 
-n = 10
-out = 'out'
-model.dropsim(n, v, l, R, D, Dr, R_d, dim, t_max, dt, out, every, Dr_c,
-              align=align, tracking=True)
+def number(s):
+    # Keep integers as integers, so they appear as such in directory names.
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+parser = argparse.ArgumentParser(
+    description='Run droplet simulations over a grid of parameters')
+parser.add_argument('--n', type=int, nargs='+',
+                    default=[sweep.defaults['n']],
+                    help='Number of particles')
+parser.add_argument('--v', type=number, nargs='+',
+                    default=[sweep.defaults['v']],
+                    help='Swimming speed')
+parser.add_argument('--l', type=number, nargs='+',
+                    default=[sweep.defaults['l']],
+                    help='Segment length')
+parser.add_argument('--R', type=number, nargs='+',
+                    default=[sweep.defaults['R']],
+                    help='Particle radius')
+parser.add_argument('--D', type=number, nargs='+',
+                    default=[sweep.defaults['D']],
+                    help='Translational diffusion constant')
+parser.add_argument('--Dr', type=number, nargs='+',
+                    default=[sweep.defaults['Dr']],
+                    help='Rotational diffusion constant')
+parser.add_argument('--R_d', type=number, nargs='+',
+                    default=[sweep.defaults['R_d']],
+                    help='Droplet radius')
+parser.add_argument('--Dr_c', type=number, nargs='+',
+                    default=[sweep.defaults['Dr_c']],
+                    help='Rotational diffusion constant after collisions')
+parser.add_argument('--dim', type=int, default=3,
+                    help='Dimension')
+parser.add_argument('--t_max', type=float, default=10000.0,
+                    help='Run time')
+parser.add_argument('--dt', type=float, default=sweep.defaults['dt'],
+                    help='Time step')
+parser.add_argument('--every', type=int, default=100,
+                    help='Number of steps between outputs')
+parser.add_argument('--no-align', dest='align', default=True,
+                    action='store_false',
+                    help='Do not align particles to the droplet wall')
+parser.add_argument('-c', '--checkpoint_every', type=int, default=None,
+                    help='Number of steps between checkpoints')
+parser.add_argument('--summary_dr', type=float, default=None,
+                    help='Bin width of radial histograms gathered every '
+                         'step into summary.npz. Off if not given')
+parser.add_argument('--steady_block', type=float, default=None,
+                    help='Block length of the steady-state monitor, which '
+                         'stops each run early once steady. Off if not given')
+parser.add_argument('--steady_tol', type=float, default=0.02,
+                    help='Relative tolerance of the steady-state monitor')
+parser.add_argument('--steady_sigma', type=float, default=0.0,
+                    help='Standard errors the steady-state monitor allows on '
+                         'top of its relative tolerance')
+parser.add_argument('--instrument', type=float, default=None,
+                    help='Seconds between lines of per-phase timings logged '
+                         'to instruments.log. Off if not given')
+parser.add_argument('-s', '--seed', type=int, default=None,
+                    help='Seed for the random streams of the whole sweep')
+parser.add_argument('-o', '--out', default='out',
+                    help='Directory in which to put output directories')
+parser.add_argument('-w', '--workers', type=int, default=None,
+                    help='Number of processes, default the number of CPUs')
+args = parser.parse_args()
+
+summary = None
+if args.summary_dr is not None:
+    summary = dict(dr=args.summary_dr)
+steady = None
+if args.steady_block is not None:
+    steady = dict(t_block=args.steady_block, tol=args.steady_tol,
+                  n_sigma=args.steady_sigma)
+
+points = sweep.grid(n=args.n, v=args.v, l=args.l, R=args.R, D=args.D,
+                    Dr=args.Dr, R_d=args.R_d, Dr_c=args.Dr_c)
+sweep.run_sweep(points, args.out, args.workers, args.seed, dim=args.dim,
+                t_max=args.t_max, dt=args.dt, every=args.every,
+                align=args.align, tracking=True,
+                checkpoint_every=args.checkpoint_every, resume=True,
+                summary=summary, steady=steady, instrument=args.instrument)
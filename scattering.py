@@ -0,0 +1,264 @@
+"""
+Functions relating to tracking how particles scatter after collisions.
+"""
+from __future__ import print_function, division
+import os
+import struct
+import numpy as np
+
+# Space reserved for the header of a streamed events file, so that it can be
+# rewritten in place as the file grows.
+header_size = 256
+
+
+def event_dtype(dim):
+    """Record type of a scattering event in a streamed events file."""
+    return np.dtype([('i', '<i8'), ('t', '<f8'), ('r1', '<f8', (dim,)),
+                     ('r2', '<f8', (dim,))])
+
+
+class EventBuffer(object):
+    """Scattering events, stored in arrays that grow as needed.
+
+    Parameters
+    ----------
+    dim: int
+        Dimension of the position vectors.
+    capacity: int
+        Number of events to allocate space for initially.
+    """
+
+    def __init__(self, dim, capacity=1024):
+        self.n = 0
+        self._i = np.empty([capacity], dtype=np.intp)
+        self._t = np.empty([capacity])
+        self._r1 = np.empty([capacity, dim])
+        self._r2 = np.empty([capacity, dim])
+
+    def _grow(self, capacity):
+        for name in ('_i', '_t', '_r1', '_r2'):
+            a = getattr(self, name)
+            a_new = np.empty((capacity,) + a.shape[1:], dtype=a.dtype)
+            a_new[:self.n] = a[:self.n]
+            setattr(self, name, a_new)
+
+    def flush(self):
+        """Nothing to write, as events are only held in memory. For
+        interchangeability with `EventStream`."""
+
+    def close(self):
+        """As `flush`."""
+
+    def extend(self, i, t, r1, r2):
+        """Add a block of events.
+
+        Parameters
+        ----------
+        i: integer array, shape (m,)
+            Index of the particle involved in each event.
+        t: float or array, shape (m,)
+            Time at which each event ended.
+        r1, r2: array, shape (m, d)
+            Position of each particle at the start and end of its event.
+        """
+        m = len(r1)
+        if self.n + m > len(self._t):
+            self._grow(max(2 * len(self._t), self.n + m))
+        self._i[self.n:self.n + m] = i
+        self._t[self.n:self.n + m] = t
+        self._r1[self.n:self.n + m] = r1
+        self._r2[self.n:self.n + m] = r2
+        self.n += m
+
+    @property
+    def i(self):
+        return self._i[:self.n]
+
+    @property
+    def t(self):
+        return self._t[:self.n]
+
+    @property
+    def r1(self):
+        return self._r1[:self.n]
+
+    @property
+    def r2(self):
+        return self._r2[:self.n]
+
+
+class EventStream(object):
+    """Scattering events, written to disk in fixed-size chunks as they come
+    in, so that memory use stays flat however many there are.
+
+    Events go to an `.npy` file of `event_dtype` records. Its header is
+    brought up to date with each chunk, so the file can be read at any time.
+    While the run goes on, the file is named `fname + '.part'`. Closing it
+    renames it to `fname`.
+
+    A stream can be pickled, such as in a checkpoint. Unpickling it drops
+    any events written to the file after it was pickled.
+
+    Parameters
+    ----------
+    fname: str
+        Path of the file to write.
+    dim: int
+        Dimension of the position vectors.
+    chunk: int
+        Number of events to hold in memory before writing them.
+    """
+
+    def __init__(self, fname, dim, chunk=4096):
+        self.fname = fname
+        self.dim = dim
+        self.chunk = chunk
+        self.n_written = 0
+        self._start()
+        with open(self.fname + '.part', 'wb') as f:
+            self._write_header(f)
+
+    def _start(self):
+        self._buffer = np.empty([self.chunk], dtype=event_dtype(self.dim))
+        self.n = 0
+
+    def _write_header(self, f):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+            np.lib.format.dtype_to_descr(self._buffer.dtype), self.n_written)
+        header = header.ljust(header_size - 11) + '\n'
+        f.seek(0)
+        f.write(np.lib.format.magic(1, 0))
+        f.write(struct.pack('<H', len(header)))
+        f.write(header.encode('latin1'))
+
+    def extend(self, i, t, r1, r2):
+        """Add a block of events. See `EventBuffer.extend`."""
+        m = len(r1)
+        t = np.broadcast_to(t, (m,))
+        k = 0
+        while k < m:
+            k_new = min(m, k + self.chunk - self.n)
+            events = self._buffer[self.n:self.n + k_new - k]
+            events['i'] = i[k:k_new]
+            events['t'] = t[k:k_new]
+            events['r1'] = r1[k:k_new]
+            events['r2'] = r2[k:k_new]
+            self.n += k_new - k
+            k = k_new
+            if self.n == self.chunk:
+                self.flush()
+
+    def flush(self):
+        """Write the events held in memory."""
+        with open(self.fname + '.part', 'r+b') as f:
+            f.seek(header_size + self.n_written * self._buffer.itemsize)
+            self._buffer[:self.n].tofile(f)
+            self.n_written += self.n
+            self._write_header(f)
+        self.n = 0
+
+    def close(self):
+        """Write any remaining events, and give the file its final name."""
+        self.flush()
+        os.rename(self.fname + '.part', self.fname)
+
+    def __getstate__(self):
+        self.flush()
+        return dict(fname=self.fname, dim=self.dim, chunk=self.chunk,
+                    n_written=self.n_written)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._start()
+        # Carry on a stream that was closed, such as to extend a run.
+        if not os.path.exists(self.fname + '.part'):
+            os.rename(self.fname, self.fname + '.part')
+        with open(self.fname + '.part', 'r+b') as f:
+            f.truncate(header_size + self.n_written * self._buffer.itemsize)
+            self._write_header(f)
+
+
+def load_events(fname):
+    """Load streamed scattering events, through memory mapping.
+
+    Parameters
+    ----------
+    fname: str
+        Path of the events file.
+
+    Returns
+    -------
+    events: record array, shape (m,)
+        Events, with fields `i`, `t`, `r1` and `r2`.
+    """
+    return np.load(fname, mmap_mode='r')
+
+
+class Tracker(object):
+    """Follow particles for a relaxation time after each collision, and
+    record where they started and ended up.
+
+    A particle that collides while already being tracked is not restarted.
+
+    Parameters
+    ----------
+    r: array, shape (n, d)
+        Initial particle positions.
+    t_relax: float
+        Time to follow each particle for after it collides.
+    always: bool
+        Whether to track particles whether or not they collide, such as when
+        there is only one particle.
+    fname: str, optional
+        If given, stream events to this file as an `EventStream`, rather
+        than holding them all in memory.
+    """
+
+    def __init__(self, r, t_relax, always=False, fname=None):
+        self.t_relax = t_relax
+        self.always = always
+        self.t_scat = np.ones([len(r)]) * np.inf
+        self.r_scat = r.copy()
+        if fname is None:
+            self.events = EventBuffer(r.shape[-1])
+        else:
+            self.events = EventStream(fname, r.shape[-1])
+
+    def update(self, t, r, c_neighb):
+        """Finish any tracks that have run their course, then start tracks
+        for particles that just collided.
+
+        Parameters
+        ----------
+        t: float
+            Current time.
+        r: array, shape (n, d)
+            Current particle positions.
+        c_neighb: bool array, shape (n,)
+            Whether each particle collided this step.
+        """
+        finished = t > self.t_scat
+        if np.any(finished):
+            self.events.extend(np.flatnonzero(finished), t,
+                               self.r_scat[finished], r[finished])
+            self.t_scat[finished] = np.inf
+
+        start = np.isinf(self.t_scat)
+        if not self.always:
+            start &= c_neighb
+        self.t_scat[start] = t + self.t_relax
+        self.r_scat[start] = r[start]
+
+    def save(self, fname, particles=None):
+        """Save the recorded events.
+
+        Parameters
+        ----------
+        fname: str
+            Path of the npz file to write.
+        particles: bool array, shape (n,), optional
+            If given, only save events involving these particles.
+        """
+        keep = slice(None) if particles is None else particles[self.events.i]
+        np.savez(fname, t=self.events.t[keep], r1=self.events.r1[keep],
+                 r2=self.events.r2[keep])
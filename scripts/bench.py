@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+Time the simulation and analysis hot paths at several problem sizes, and
+compare the results with those of an earlier run, such as from before an
+upgrade.
+
+Every case is seeded, so runs differ only in how long they take. Results
+are saved as an npz file holding the name of each case, its best time over
+some repeats, the peak memory allocated while running it once, and which
+numerics backend ran it.
+"""
+from __future__ import print_function, division
+import argparse
+import os
+import platform
+import shutil
+import tempfile
+from timeit import default_timer
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+import numpy as np
+from mindrop import model, numerics, diffusion, streams, sweep, trajectory
+from mindrop.utils import dataset
+
+# Particle parameters and time step, as the defaults of `run.py`.
+l, R, v, D, Dr, Dr_c, dt = [sweep.defaults[key] for key in
+                            ('l', 'R', 'v', 'D', 'Dr', 'Dr_c', 'dt')]
+# Volume fraction from which to size droplets for a number of particles.
+phi = 0.05
+
+
+def droplet_radius(n, dim=3):
+    V_p = np.pi * R ** 2 * l + (4.0 / 3.0) * np.pi * R ** 3
+    return (3.0 * n * V_p / (4.0 * np.pi * phi)) ** (1.0 / 3.0)
+
+
+def packed(n, R_d, dim=3):
+    rng = streams.make_rng(0)
+    return model.packers['lattice'](n, l, R, R_d, dim, rng)
+
+
+def measure(func, setup, repeat):
+    # Best time of a call, and peak memory allocated in one. Anything `setup`
+    # returns is passed to `func`, and set up again before each call.
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        t_start = default_timer()
+        func(*args)
+        times.append(default_timer() - t_start)
+    peak = np.nan
+    if tracemalloc is not None:
+        args = setup()
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def case_hard_core(n):
+    R_d = droplet_radius(n)
+    r_old, u_old = packed(n, R_d)
+
+    def setup():
+        r, u = r_old.copy(), u_old.copy()
+        r += u * v * dt
+        return r, u
+    return (lambda r, u: model.do_hard_core(r, u, l, R, R_d, r_old, u_old),
+            setup, 1)
+
+
+def case_collisions(n):
+    R_d = droplet_radius(n)
+    r, u = packed(n, R_d)
+    return (lambda: model.collisions(r, u, l, R, R_d), tuple, 1)
+
+
+def case_radial_distance(n):
+    R_d = droplet_radius(n)
+    r, u = packed(n, R_d)
+    return (lambda: numerics.spherocylinder_radial_distance_sq(r, u, l, R,
+                                                               R_d),
+            tuple, 1)
+
+
+def case_rot_diff(n):
+    u = streams.sphere_pick(streams.make_rng(0), 3, n)
+
+    def setup():
+        return u.copy(), streams.make_rng(0)
+    return (lambda u, rng: diffusion.rot_diff(u, Dr, dt, rng, out=u),
+            setup, 1)
+
+
+def case_diff(n):
+    r = np.zeros([n, 3])
+
+    def setup():
+        return r.copy(), streams.make_rng(0)
+    return (lambda r, rng: diffusion.diff(r, D, dt, rng, out=r), setup, 1)
+
+
+def case_dropsim(n, R_d, engine, steps=100):
+    # Timed per step. Lattice packing is quick enough not to count.
+    def run(rng):
+        model.dropsim(n, v, l, R, D, Dr, R_d, 3, steps * dt, dt, None, steps,
+                      Dr_c, pack='lattice', engine=engine, rng=rng)
+
+    def setup():
+        return (streams.make_rng(0),)
+    return run, setup, steps
+
+
+def write_set(dirname, n, m, R_d, seed):
+    # A synthetic run, with most particles spread over the droplet and the
+    # rest in a peak at the wall.
+    rng = streams.make_rng(seed)
+    os.makedirs(os.path.join(dirname, 'dyn'))
+    np.savez(os.path.join(dirname, 'static'), l=l, R=R, R_d=R_d)
+    traj = trajectory.Trajectory(os.path.join(dirname, 'dyn'), n, 3, m)
+    for k in range(m):
+        u_r = streams.sphere_pick(rng, 3, n)
+        s = R_d * rng.uniform(0.0, 1.0, n) ** (1.0 / 3.0)
+        peak = rng.uniform(0.0, 1.0, n) < 0.3
+        s[peak] = rng.uniform(0.9 * R_d, R_d, np.count_nonzero(peak))
+        traj.append(k * dt, u_r * s[:, np.newaxis], u_r)
+    traj.close()
+
+
+def case_dataset(m, n=100, R_d=16.0):
+    set_dir = tempfile.mkdtemp()
+    write_set(set_dir, n, m, R_d, 0)
+    return lambda: dataset.get_dset(set_dir), tuple, 1, set_dir
+
+
+def case_rcf(m, n=100, R_d=16.0):
+    set_dir = tempfile.mkdtemp()
+    write_set(set_dir, n, m, R_d, 0)
+    dset = dataset.get_dset(set_dir)
+
+    def setup():
+        np.random.seed(0)
+        return ()
+    return lambda: dset.get_rcf(0.5, 10000, 0.0), setup, 1, set_dir
+
+
+def case_acf(m, n=100, R_d=16.0):
+    set_dir = tempfile.mkdtemp()
+    write_set(set_dir, n, m, R_d, 0)
+    dset = dataset.get_dset(set_dir)
+
+    def setup():
+        np.random.seed(0)
+        return ()
+    return lambda: dset.get_acf(0.05, 10000, 0.0), setup, 1, set_dir
+
+
+def case_fit(sets, m=20, R_d=16.0):
+    root = tempfile.mkdtemp()
+    set_dirs = [os.path.join(root, 'set_{}'.format(k)) for k in range(sets)]
+    for k, set_dir in enumerate(set_dirs):
+        write_set(set_dir, 50 * (k + 1), m, R_d, k)
+    superset = dataset.Superset(set_dirs)
+    return lambda: superset.fit_to_model('mean', 0.5), tuple, 1, root
+
+
+def get_cases(quick):
+    # Name, function to make the case, and the arguments of each size.
+    if quick:
+        ns, ms, sets = [100, 1000], [10], [3]
+        drop_sizes = [(50, 8.0), (200, 12.0)]
+    else:
+        ns, ms, sets = [100, 1000, 10000], [10, 100], [3, 10]
+        drop_sizes = [(50, 8.0), (200, 8.0), (200, 16.0), (1000, 16.0)]
+    cases = []
+    for n in ns:
+        cases.extend([
+            ('do_hard_core[n={}]'.format(n), case_hard_core, (n,)),
+            ('collisions[n={}]'.format(n), case_collisions, (n,)),
+            ('spherocylinder_radial_distance_sq[n={}]'.format(n),
+             case_radial_distance, (n,)),
+            ('rot_diff[n={}]'.format(n), case_rot_diff, (n,)),
+            ('diff[n={}]'.format(n), case_diff, (n,)),
+        ])
+    # The compiled engine needs the compiled numerics.
+    engines = ['python']
+    if numerics.backend == 'compiled':
+        engines.append('compiled')
+    for n, R_d in drop_sizes:
+        for engine in engines:
+            cases.append(('dropsim_step[{},n={},R_d={}]'.format(engine, n,
+                                                                R_d),
+                          case_dropsim, (n, R_d, engine)))
+    for m in ms:
+        cases.extend([
+            ('Dataset[snapshots={}]'.format(m), case_dataset, (m,)),
+            ('Dataset.get_rcf[snapshots={}]'.format(m), case_rcf, (m,)),
+            ('Dataset.get_acf[snapshots={}]'.format(m), case_acf, (m,)),
+        ])
+    for n_sets in sets:
+        cases.append(('Superset.fit_to_model[sets={}]'.format(n_sets),
+                      case_fit, (n_sets,)))
+    return cases
+
+
+def run_cases(cases, repeat, match=None):
+    names, times, peaks = [], [], []
+    for name, make_case, args in cases:
+        if match is not None and match not in name:
+            continue
+        case = make_case(*args)
+        func, setup, units = case[:3]
+        try:
+            time, peak = measure(func, setup, repeat)
+        finally:
+            # Remove any files the case wrote.
+            for path in case[3:]:
+                shutil.rmtree(path)
+        time /= units
+        print('{:<52} {:>12.3e} s {:>10.1f} MB'.format(name, time,
+                                                       peak / 2.0 ** 20))
+        names.append(name)
+        times.append(time)
+        peaks.append(peak)
+    return names, times, peaks
+
+
+def compare(fname, names, times, peaks, tol):
+    # Print the ratio of each time and peak to an earlier one, flagging
+    # increases.
+    with np.load(fname) as f:
+        old_times = dict(zip(f['names'], f['times']))
+        old_peaks = dict(zip(f['names'], f['peaks']))
+        old_backend = (str(f['numerics_backend'])
+                       if 'numerics_backend' in f.files else None)
+    print('\nCompared with {}:'.format(fname))
+    if old_backend != numerics.backend:
+        print('WARNING: numerics backend was {}, and is now {}, so the '
+              'ratios compare different kernels'.format(old_backend,
+                                                        numerics.backend))
+    for name, time, peak in zip(names, times, peaks):
+        if name not in old_times:
+            continue
+        ratio = time / old_times[name]
+        peak_ratio = peak / old_peaks[name]
+        flags = ''
+        if ratio > tol:
+            flags += '  SLOWER'
+        if peak_ratio > tol:
+            flags += '  MORE MEMORY'
+        print('{:<52} {:>8.2f}x {:>8.2f}x{}'.format(name, ratio, peak_ratio,
+                                                    flags))
+
+
+parser = argparse.ArgumentParser(
+    description='Time the simulation and analysis hot paths')
+parser.add_argument('-o', '--out', default=None,
+                    help='npz file in which to save the results')
+parser.add_argument('-c', '--compare', default=None,
+                    help='npz file of earlier results to compare with')
+parser.add_argument('-r', '--repeat', type=int, default=5,
+                    help='Number of times to run each case')
+parser.add_argument('-k', '--match', default=None,
+                    help='Only run cases whose names contain this')
+parser.add_argument('--quick', default=False, action='store_true',
+                    help='Only run the smaller sizes')
+parser.add_argument('--tol', type=float, default=1.2,
+                    help='Ratio of times or peaks above which to flag an '
+                         'increase')
+args = parser.parse_args()
+
+names, times, peaks = run_cases(get_cases(args.quick), args.repeat,
+                                args.match)
+if args.out is not None:
+    np.savez(args.out, names=np.array(names), times=np.array(times),
+             peaks=np.array(peaks), numpy_version=np.__version__,
+             python_version=platform.python_version(),
+             numerics_backend=numerics.backend)
+if args.compare is not None:
+    compare(args.compare, names, times, peaks, args.tol)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Check that the compiled and NumPy numerics backends give the same
+trajectories, by running a seeded droplet in 2D and in 3D with each, and
+comparing the positions they write.
+
+Needs the compiled numerics to have been built with `setup.py`.
+"""
+from __future__ import print_function, division
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+from mindrop import model, numerics, sweep
+
+# Particle parameters and time step, as the defaults of `run.py`.
+l, R, v, D, Dr, Dr_c, dt = [sweep.defaults[key] for key in
+                            ('l', 'R', 'v', 'D', 'Dr', 'Dr_c', 'dt')]
+# Droplet radius for each dimension, small enough for frequent collisions,
+# but large enough to pack the particles.
+R_ds = {2: 12.0, 3: 6.0}
+
+
+def run(backend, dim, n, steps, seed, root):
+    numerics.use(backend)
+    out = os.path.join(root, '{}_{}d'.format(backend, dim))
+    model.dropsim(n, v, l, R, D, Dr, R_ds[dim], dim, steps * dt, dt, out, 1,
+                  Dr_c, rng=seed)
+    return np.load(os.path.join(out, 'dyn', 'r.npy'))
+
+
+parser = argparse.ArgumentParser(
+    description='Check that the numerics backends give the same trajectories')
+parser.add_argument('-n', type=int, default=100,
+                    help='Number of particles')
+parser.add_argument('--steps', type=int, default=100,
+                    help='Number of steps')
+parser.add_argument('-s', '--seed', type=int, default=0,
+                    help='Random number generator seed')
+args = parser.parse_args()
+
+root = tempfile.mkdtemp()
+failed = False
+try:
+    for dim in (2, 3):
+        r_compiled = run('compiled', dim, args.n, args.steps, args.seed, root)
+        r_numpy = run('numpy', dim, args.n, args.steps, args.seed, root)
+        same = np.array_equal(r_compiled, r_numpy)
+        print('{}D: {}'.format(dim, 'same' if same else 'DIFFERENT'))
+        failed |= not same
+finally:
+    shutil.rmtree(root)
+if failed:
+    sys.exit(1)
@@ -4,6 +4,21 @@ import argparse
 import numpy as np
 import vtk
 from vtk.util.numpy_support import numpy_to_vtk
+from mindrop import trajectory
+
+
+def get_frames(dyns):
+    # Get a name and state for each snapshot. Trajectory directories are read
+    # through memory mapping, and npz files are left to be loaded when shown.
+    frames = []
+    for dyn in dyns:
+        if os.path.isdir(dyn):
+            t, r, u = trajectory.load(dyn)
+            frames.extend(('%010f' % t[k], r[k], u[k]) for k in range(len(t)))
+        else:
+            name = os.path.splitext(os.path.basename(dyn.strip()))[0]
+            frames.append((name, dyn.strip(), None))
+    return frames
 
 
 def progress_renwin(renWin):
@@ -14,19 +29,20 @@ def progress_renwin(renWin):
         renWin.index += 1
     elif key == 'Left':
         renWin.index -= 1
-    fname = renWin.fnames[renWin.index]
+    name, r, u = renWin.frames[renWin.index]
 
-    dyn = np.load(fname.strip())
-
-    r = dyn['r']
-    u = dyn['u']
+    # An npz snapshot, with only its file name known.
+    if u is None:
+        dyn = np.load(r)
+        r = dyn['r']
+        u = dyn['u']
 
     if renWin.cross:
         in_slice = np.abs(r[:, -1]) < renWin.cross
         r = r[in_slice]
         u = u[in_slice]
 
-    renWin.timeActor.SetInput(fname)
+    renWin.timeActor.SetInput(name)
 
     renWin.particleCPoints.SetData(numpy_to_vtk(r))
     renWin.particleCPolys.GetPointData().SetVectors(numpy_to_vtk(u))
@@ -38,7 +54,7 @@ def progress_renwin(renWin):
     renWin.particleE2Points.SetData(numpy_to_vtk(re2))
 
     renWin.Render()
-    return fname
+    return name
 
 
 def progress_iren(obj, *args, **kwargs):
@@ -46,7 +62,10 @@ def progress_iren(obj, *args, **kwargs):
 
 
 def vis(dyns, save, cross):
-    datdir = os.path.abspath(os.path.join(dyns[0], '../..'))
+    if os.path.isdir(dyns[0]):
+        datdir = os.path.abspath(os.path.join(dyns[0], '..'))
+    else:
+        datdir = os.path.abspath(os.path.join(dyns[0], '../..'))
     stat = np.load('%s/static.npz' % datdir)
     l = stat['l']
     lu, ld = l / 2.0, l / 2.0
@@ -145,7 +164,7 @@ def vis(dyns, save, cross):
     particlesE2Actor.GetProperty().SetColor(0, 1, 0)
     ren.AddActor(particlesE2Actor)
 
-    renWin.fnames = dyns
+    renWin.frames = get_frames(dyns)
     renWin.index = 0
     renWin.l = l
     renWin.cross = cross
@@ -164,17 +183,17 @@ def vis(dyns, save, cross):
         iren.Start()
     else:
         while True:
-            fname = progress_renwin(renWin)
-            print(fname)
-            outname = os.path.splitext(os.path.basename(fname))[0]
+            name = progress_renwin(renWin)
+            print(name)
             winImFilt.Modified()
-            writer.SetFileName('{}.jpg'.format(outname))
+            writer.SetFileName('{}.jpg'.format(name))
             writer.Write()
 
 parser = argparse.ArgumentParser(
     description='Visualise system states using VTK')
 parser.add_argument('dyns', nargs='*',
-                    help='npz files containing dynamic states')
+                    help='Trajectory directories, or npz files containing '
+                         'dynamic states')
 parser.add_argument('-s', '--save', default=False, action='store_true',
                     help='Save plot')
 parser.add_argument('-c', '--cross', type=float, default=None,
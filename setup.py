@@ -5,6 +5,8 @@ import numpy as np
 
 setup(
     cmdclass={'build_ext': build_ext},
-    ext_modules=[Extension("numerics", ["numerics.pyx"])],
+    ext_modules=[Extension("_numerics", ["_numerics.pyx"],
+                           extra_compile_args=['-fopenmp'],
+                           extra_link_args=['-fopenmp'])],
     include_dirs=[np.get_include()],
 )
@@ -0,0 +1,191 @@
+"""
+Functions relating to streams of random numbers.
+"""
+from __future__ import print_function, division
+import threading
+import numpy as np
+
+
+def make_rng(seed=None):
+    """Get a random number generator.
+
+    Parameters
+    ----------
+    seed: None, int, numpy.random.SeedSequence or numpy.random.Generator
+        Seed for a new generator using the PCG64 bit generator, or an
+        existing generator, which is returned unchanged.
+        If None, seed from fresh entropy.
+
+    Returns
+    -------
+    rng: numpy.random.Generator
+    """
+    return np.random.default_rng(seed)
+
+
+def spawn(seed, n):
+    """Get seeds for independent child streams.
+
+    Parameters
+    ----------
+    seed: None, int, numpy.random.SeedSequence or numpy.random.Generator
+        Seed of the parent stream, or a generator to spawn from. The same
+        seed always gives the same children, while each call on the same
+        generator gives new ones.
+    n: int
+        Number of children.
+
+    Returns
+    -------
+    seeds: list of numpy.random.SeedSequence
+        Seeds that can be passed to `make_rng`, or pickled and sent to
+        another process.
+    """
+    if isinstance(seed, np.random.Generator):
+        seed = seed.bit_generator.seed_seq
+    elif not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return seed.spawn(n)
+
+
+def sphere_pick(rng, dim, n=1):
+    """Pick unit vectors uniformly distributed over the sphere.
+
+    Parameters
+    ----------
+    rng: numpy.random.Generator
+    dim: int
+        Dimension of the vectors.
+    n: int
+        Number of vectors.
+
+    Returns
+    -------
+    u: array, shape (n, dim)
+    """
+    u = rng.standard_normal((n, dim))
+    u /= np.sqrt(np.sum(np.square(u), axis=-1))[:, np.newaxis]
+    return u
+
+
+class NoiseBlock(object):
+    """A source of standard normal samples, drawn from a generator in large
+    blocks and handed out a piece at a time.
+
+    The samples handed out are the generator's own sequence, in order,
+    whatever the sizes asked for, so this can stand in for the generator
+    wherever only standard normal samples are needed.
+
+    Parameters
+    ----------
+    rng: numpy.random.Generator
+        Generator to draw the blocks from.
+    block_size: int
+        Number of samples in each block.
+    background: bool
+        Whether to draw the next block in a background thread while the
+        current one is used.
+    """
+
+    def __init__(self, rng, block_size=2 ** 16, background=False):
+        self.rng = rng
+        self.block_size = block_size
+        self.background = background
+        self._block = np.empty([block_size])
+        # Start out empty, so the first request draws a block.
+        self._pos = block_size
+        # Blocks that have been drawn but not yet used.
+        self._pending = []
+        # Block that was used up last, which views may still point into.
+        self._retired = None
+        self._thread = None
+        self._filling = None
+
+    def _fill(self, block):
+        self.rng.standard_normal(out=block)
+
+    def _prefetch(self, block):
+        self._filling = block
+        self._thread = threading.Thread(target=self._fill, args=(block,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _join(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._pending.append(self._filling)
+            self._thread = None
+            self._filling = None
+
+    def _next_block(self):
+        self._join()
+        # Only draw over a block once the one after it has been used up, so
+        # that views into it stay valid for a block's worth of samples.
+        spare, self._retired = self._retired, self._block
+        if self._pending:
+            self._block = self._pending.pop(0)
+        else:
+            self._block = np.empty([self.block_size])
+            self._fill(self._block)
+        self._pos = 0
+        if self.background:
+            if spare is None:
+                spare = np.empty([self.block_size])
+            self._prefetch(spare)
+
+    def standard_normal(self, size=None, out=None):
+        """Get samples from the standard normal distribution.
+
+        Parameters
+        ----------
+        size: int or tuple of ints, optional
+            Shape of the samples. Ignored if `out` is given.
+        out: array, optional
+            Array to fill.
+
+        Returns
+        -------
+        out: array
+            Samples, or a float if neither `size` nor `out` is given.
+            If `out` is not given, this may be a view into the current
+            block, which stays valid until at least `block_size` more
+            samples have been handed out.
+        """
+        if out is None and size is None:
+            return float(self.standard_normal(size=1)[0])
+        if out is not None:
+            m = out.size
+        elif isinstance(size, (tuple, list)):
+            m = 1
+            for s in size:
+                m *= s
+        else:
+            m = size
+        if self._pos + m <= self.block_size:
+            # Usual case, where the current block has enough samples left.
+            sample = self._block[self._pos:self._pos + m]
+            self._pos += m
+            if out is None:
+                return sample.reshape(size)
+            out[...] = sample.reshape(out.shape)
+            return out
+        sample = np.empty([m])
+        k = 0
+        while k < m:
+            if self._pos == self.block_size:
+                self._next_block()
+            k_new = min(m, k + self.block_size - self._pos)
+            sample[k:k_new] = self._block[self._pos:self._pos + k_new - k]
+            self._pos += k_new - k
+            k = k_new
+        if out is None:
+            return sample.reshape(size)
+        out[...] = sample.reshape(out.shape)
+        return out
+
+    def __getstate__(self):
+        # A thread cannot be pickled, so finish any block being drawn.
+        self._join()
+        state = self.__dict__.copy()
+        state['_thread'] = None
+        return state
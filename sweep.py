@@ -0,0 +1,129 @@
+"""
+Functions relating to running simulations over many sets of parameters.
+"""
+from __future__ import print_function, division
+import itertools
+import multiprocessing
+from os.path import join, exists
+import numpy as np
+from mindrop import model, numerics, streams
+
+# Parameters that identify a point, and their codes in directory names.
+codes = [
+    ('n', 'n'),
+    ('v', 'v'),
+    ('l', 'l'),
+    ('R', 'R'),
+    ('D', 'D'),
+    ('Dr', 'Dr'),
+    ('R_d', 'Rd'),
+    ('Dr_c', 'Drc'),
+]
+
+# Default parameters, as used by `run.py`.
+defaults = dict(n=10, v=13.5, l=1.23, R=0.36, D=0.25, Dr=0.05, R_d=16.0,
+                Dr_c=10, dt=0.01)
+
+
+def point_dirname(params):
+    """Get the directory name for a set of `dropsim` parameters,
+    such as `n_10_v_13.5_l_1.23_R_0.36_D_0.25_Dr_0.05_Rd_16.0_Drc_10`.
+
+    Values are formatted as given, so an integer `Dr_c` of 10 gives `Drc_10`
+    and a float gives `Drc_10.0`.
+    """
+    return '_'.join('{}_{}'.format(code, params[key]) for key, code in codes)
+
+
+def grid(**params):
+    """Get every combination of some lists of parameter values.
+
+    Parameters
+    ----------
+    params:
+        A sequence of values for each parameter.
+
+    Returns
+    -------
+    points: list of dict
+        Parameters of each point.
+    """
+    keys = sorted(params)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*[params[k] for k in keys])]
+
+
+def is_complete(out, tracking):
+    """Whether a point's output directory holds a finished run.
+
+    `dropsim` writes `done.npz` once everything else is written, so a run
+    is finished once that is readable. Older runs wrote no marker, and
+    count as finished if they were tracked and their events file,
+    `tracking.npz`, is readable, as it was only written at the end.
+    Older runs without tracking cannot be told apart from killed ones, so
+    are run again.
+    """
+    path = join(out, 'done.npz')
+    if tracking and not exists(path):
+        path = join(out, 'tracking.npz')
+    if not exists(path):
+        return False
+    try:
+        with np.load(path) as f:
+            for key in f.files:
+                f[key]
+    except Exception:
+        return False
+    return True
+
+
+def _init_worker():
+    # The pool already has a process per CPU, so each should only use one.
+    # The thread count must be set in the worker itself, as the OpenMP
+    # runtime reads the environment only once, when first loaded.
+    numerics.set_num_threads(1)
+
+
+def _run_point(args):
+    params, out = args
+    model.dropsim(out=out, **params)
+    return out
+
+
+def run_sweep(points, out_dir, workers=None, seed=None, **kwargs):
+    """Run `dropsim` for each of a set of parameter points, across a pool of
+    processes. Points whose output is already complete are skipped.
+
+    Each point gets its own independent random stream, spawned from `seed`,
+    so a sweep with a given seed is reproducible whatever the number of
+    workers.
+
+    Parameters
+    ----------
+    points: list of dict
+        `dropsim` parameters that vary between points.
+    out_dir: str
+        Directory in which to put each point's output directory.
+    workers: int, optional
+        Number of processes. Defaults to the number of CPUs.
+    seed: None, int or numpy.random.SeedSequence, optional
+        Seed from which to spawn each point's stream.
+    kwargs:
+        `dropsim` parameters shared by all points.
+    """
+    jobs = []
+    for point, point_seed in zip(points, streams.spawn(seed, len(points))):
+        params = dict(kwargs, rng=point_seed, **point)
+        out = join(out_dir, point_dirname(params))
+        if is_complete(out, params.get('tracking', False)):
+            print('Skipping complete point {}'.format(out))
+            continue
+        jobs.append((params, out))
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker)
+    try:
+        for out in pool.imap_unordered(_run_point, jobs):
+            print('Finished point {}'.format(out))
+    finally:
+        pool.close()
+        pool.join()
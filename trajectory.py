@@ -0,0 +1,246 @@
+"""
+Functions relating to storing the states of a run over time.
+
+A trajectory is a directory holding three `.npy` files: `r.npy` and
+`u.npy`, of shape (m, n, d), hold the positions and orientations at each
+snapshot, and `t.npy`, of shape (m,), holds the time of each snapshot.
+The files are sized up front and filled in as the run goes, with the times
+of snapshots not yet written set to NaN.
+"""
+from __future__ import print_function, division
+from os.path import join, exists
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
+
+fnames = ('r.npy', 'u.npy', 't.npy')
+
+
+def exists_in(dirname):
+    """Whether a directory holds a trajectory."""
+    return all(exists(join(dirname, fname)) for fname in fnames)
+
+
+def load(dirname, mmap_mode='r'):
+    """Load the snapshots written to a trajectory.
+
+    Parameters
+    ----------
+    dirname: str
+        Trajectory directory.
+    mmap_mode: str or None
+        Mode in which to memory-map the files, as for `numpy.load`.
+
+    Returns
+    -------
+    t: array, shape (m,)
+        Time of each snapshot.
+    r, u: arrays, shape (m, n, d)
+        Positions and orientations at each snapshot.
+    """
+    t = np.load(join(dirname, 't.npy'), mmap_mode=mmap_mode)
+    m = np.count_nonzero(np.isfinite(t))
+    r = np.load(join(dirname, 'r.npy'), mmap_mode=mmap_mode)
+    u = np.load(join(dirname, 'u.npy'), mmap_mode=mmap_mode)
+    return t[:m], r[:m], u[:m]
+
+
+class Trajectory(object):
+    """Append snapshots of a run to a trajectory.
+
+    A trajectory can be pickled, such as in a checkpoint. Unpickling it
+    opens the files again, and drops any snapshots written after it was
+    pickled.
+
+    Parameters
+    ----------
+    dirname: str
+        Directory in which to put the trajectory files.
+    n: int
+        Number of particles.
+    dim: int
+        Dimension.
+    capacity: int
+        Number of snapshots to size the files for. If more are appended,
+        the files are rewritten with more space.
+    """
+
+    def __init__(self, dirname, n, dim, capacity):
+        self.dirname = dirname
+        self.k = 0
+        self._create(n, dim, max(capacity, 1))
+
+    def _create(self, n, dim, capacity):
+        r = self._open_new('r.npy', (capacity, n, dim))
+        u = self._open_new('u.npy', (capacity, n, dim))
+        t = self._open_new('t.npy', (capacity,))
+        t[:] = np.nan
+        self._r, self._u, self._t = r, u, t
+
+    def _open_new(self, fname, shape):
+        return np.lib.format.open_memmap(join(self.dirname, fname), mode='w+',
+                                         dtype=np.float64, shape=shape)
+
+    def _open(self):
+        self._r, self._u, self._t = [
+            np.load(join(self.dirname, fname), mmap_mode='r+')
+            for fname in fnames]
+
+    def _grow(self):
+        old = [a[:self.k].copy() for a in (self._r, self._u, self._t)]
+        n, dim = self._r.shape[1:]
+        capacity = 2 * len(self._t)
+        self._r = self._u = self._t = None
+        self._create(n, dim, capacity)
+        self._r[:self.k], self._u[:self.k], self._t[:self.k] = old
+
+    def append(self, t, r, u):
+        """Write a snapshot.
+
+        Parameters
+        ----------
+        t: float
+            Time.
+        r, u: arrays, shape (n, d)
+            Positions and orientations.
+        """
+        if self.k == len(self._t):
+            self._grow()
+        self._r[self.k] = r
+        self._u[self.k] = u
+        # Written last, so that a snapshot only counts once it is complete.
+        self._t[self.k] = t
+        self.k += 1
+
+    def flush(self):
+        for a in (self._r, self._u, self._t):
+            a.flush()
+
+    def __getstate__(self):
+        self.flush()
+        return dict(dirname=self.dirname, k=self.k)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+        self._t[self.k:] = np.nan
+
+    def close(self):
+        self.flush()
+
+
+class TrajectoryWriter(object):
+    """Append snapshots to a trajectory from a background thread, so that
+    writing overlaps with stepping.
+
+    Snapshots are copied and put on a bounded queue. Once it is full,
+    appending waits for the thread to catch up.
+    An error in the thread is raised again at the next call.
+
+    Parameters
+    ----------
+    traj: Trajectory
+        Trajectory to write to.
+    maxsize: int
+        Number of snapshots that can wait to be written.
+    """
+
+    def __init__(self, traj, maxsize=16):
+        self.traj = traj
+        self.maxsize = maxsize
+        self._start()
+
+    def _start(self):
+        self._queue = queue.Queue(self.maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            snapshot = self._queue.get()
+            try:
+                if snapshot is None:
+                    return
+                # After an error, keep emptying the queue so nothing blocks.
+                if self._error is None:
+                    self.traj.append(*snapshot)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def append(self, t, r, u):
+        """Write a snapshot. See `Trajectory.append`."""
+        self._check()
+        self._queue.put((t, r.copy(), u.copy()))
+
+    def flush(self):
+        """Wait for all queued snapshots to be written, and flush them."""
+        self._queue.join()
+        self._check()
+        self.traj.flush()
+
+    def close(self):
+        """Flush, then stop the thread."""
+        if self._thread is None:
+            return
+        self._queue.join()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._check()
+        self.traj.flush()
+
+    def __getstate__(self):
+        self.flush()
+        return dict(traj=self.traj, maxsize=self.maxsize)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._start()
+
+
+class ReplicaTrajectories(object):
+    """Append snapshots of replicas that are stepped together, as one
+    flattened system, to a trajectory for each.
+
+    Parameters
+    ----------
+    trajs: list of Trajectory
+        Trajectory of each replica, in the order their particles are held.
+    """
+
+    def __init__(self, trajs):
+        self.trajs = trajs
+
+    def append(self, t, r, u):
+        """Write a snapshot of every replica.
+
+        Parameters
+        ----------
+        t: float
+            Time.
+        r, u: arrays, shape (replicas * n, d)
+            Positions and orientations of all replicas' particles.
+        """
+        shape = (len(self.trajs), -1, r.shape[-1])
+        for traj, r_b, u_b in zip(self.trajs, r.reshape(shape),
+                                  u.reshape(shape)):
+            traj.append(t, r_b, u_b)
+
+    def flush(self):
+        for traj in self.trajs:
+            traj.flush()
+
+    def close(self):
+        for traj in self.trajs:
+            traj.close()
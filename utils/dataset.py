@@ -1,5 +1,5 @@
 from __future__ import print_function, division
-from os.path import join, dirname, normpath, basename
+from os.path import join, dirname, normpath, basename, exists
 import glob
 import pickle
 import numpy as np
@@ -8,6 +8,7 @@ from scipy.spatial.distance import pdist
 from scipy.optimize import curve_fit
 from spatious import vector
 from spatious.distance import pdist_angle
+from mindrop import scattering, trajectory
 
 
 def f_peak_model(eta_0, R, k, gamma,
@@ -25,6 +26,17 @@ def f_peak_model(eta_0, R, k, gamma,
     return r[-1]
 
 
+def get_run_rs(fname):
+    '''
+    Position vectors of the snapshots in a run file: either a single
+    snapshot's npz file, or one of the files of a trajectory, which is read
+    through memory mapping.
+    '''
+    if fname.endswith('.npz'):
+        return [np.load(fname)['r']]
+    return trajectory.load(dirname(fname))[1]
+
+
 def res_to_bins(r_max, dr):
     return int(round((r_max) / dr))
 
@@ -200,9 +212,10 @@ class Dataset(object):
 
         self.xyzs = []
         for d in self.run_fnames:
-            xyz = np.array([x for x in np.load(d)['r'] if self.valid_func(x)])
-            if xyz.shape[0] > 0:
-                self.xyzs.append(xyz)
+            for rs in get_run_rs(d):
+                xyz = np.array([x for x in rs if self.valid_func(x)])
+                if xyz.shape[0] > 0:
+                    self.xyzs.append(xyz)
         if self.filter_z_flag:
             self.filter_z()
 
@@ -527,7 +540,10 @@ class Dataset(object):
 
     def get_direct(self):
         set_dirname = join(dirname(self.run_fnames[0]), '..')
-        track = np.load('{}/tracking.npz'.format(set_dirname))
+        if exists(join(set_dirname, 'tracking.npy')):
+            track = scattering.load_events(join(set_dirname, 'tracking.npy'))
+        else:
+            track = np.load('{}/tracking.npz'.format(set_dirname))
         return track['t'], track['r1'], track['r2']
 
     def __getstate__(self):
@@ -541,7 +557,12 @@ def unzip(results):
 
 
 def get_dset(dset_name, *args, **kwargs):
-    return Dataset(glob.glob(join(dset_name, 'dyn/*.npz')), *args, **kwargs)
+    dyn_dirname = join(dset_name, 'dyn')
+    if trajectory.exists_in(dyn_dirname):
+        run_fnames = [join(dyn_dirname, 'r.npy')]
+    else:
+        run_fnames = glob.glob(join(dyn_dirname, '*.npz'))
+    return Dataset(run_fnames, *args, **kwargs)
 
 
 class Superset(object):